@@ -1,28 +1,47 @@
 import os
+import re
 import time
 import hmac
+import traceback
+import queue
+import threading
+from functools import lru_cache
 from importlib import import_module
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, g
 from flask_cors import CORS
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from features import extract_features, features_schema
 from config import (
     MODEL_FILE,
+    MODEL_MMAP_MODE,
+    MODEL_RELOAD_CHECK_SECONDS,
+    CACHE_EPOCH_FILE,
     ADMIN_TOKEN,
     FRONTEND_ORIGINS,
     MAX_URL_LENGTH,
+    LOG_TRACEBACKS,
+    PREDICT_BATCH_MAX,
+    PREDICT_BATCH_WAIT_MS,
+    PREDICT_TIMEOUT_SECONDS,
+    PREDICT_CACHE_SIZE,
+    FEATURE_CACHE_SIZE,
+    URL_ALLOWLIST,
+    URL_BLOCKLIST,
     DEFAULT_DATA_PATH,
     AUTH_SECRET,
     AUTH_TOKEN_TTL_SECONDS,
     ADMIN_USERNAME,
     ADMIN_PASSWORD,
 )
-import joblib
+import numpy as np
+import orjson
 from db import (
+    enqueue_prediction,
     insert_prediction,
-    get_recent,
-    get_recent_for_user,
-    get_recent_for_user_id,
+    LOG_SYNC,
+    get_recent_json,
+    get_recent_for_user_json,
+    get_recent_for_user_id_json,
     clear_logs,
     delete_logs_for_user,
     delete_logs_for_user_id,
@@ -36,9 +55,11 @@ from db import (
     set_user_password,
     get_user_by_id,
     get_user_by_email,
+    begin_connection_scope,
+    end_connection_scope,
 )
 from pathlib import Path
-from sklearn.feature_extraction import DictVectorizer  # added
+from urllib.parse import urlsplit
 
 
 def _get_client_ip(req) -> str:
@@ -49,14 +70,28 @@ def _get_client_ip(req) -> str:
     xff = (req.headers.get("X-Forwarded-For") or "").strip()
     if xff:
         # First IP in the chain is the original client
-        return xff.split(",")[0].strip()
+        comma = xff.find(",")
+        return xff[:comma].strip() if comma >= 0 else xff
     xri = (req.headers.get("X-Real-IP") or "").strip()
     if xri:
         return xri
     return (req.remote_addr or "").strip()
 
+# Only this much of the User-Agent is inspected. Real browser UAs put every
+# token below well inside it; it also bounds the memo's key size.
+_UA_PREFIX = 512
+
+
 def _device_from_user_agent(user_agent: str) -> str:
-    ua = (user_agent or "").lower()
+    return _device_from_ua_prefix((user_agent or "")[:_UA_PREFIX])
+
+
+# User agents repeat heavily across requests; resolve each distinct one once.
+# (Measured: the chain of `in` scans below already beats a compiled re
+# alternation on real UA strings, since str.__contains__ is a C fast search.)
+@lru_cache(maxsize=1024)
+def _device_from_ua_prefix(user_agent: str) -> str:
+    ua = user_agent.lower()
     if not ua:
         return "unknown"
 
@@ -88,16 +123,37 @@ def _device_from_user_agent(user_agent: str) -> str:
 
     return f"{os_name} • {browser}"
 
+def _origins_pattern(origins):
+    """Allowed origins as one anchored, case-insensitive regex for flask-cors.
+
+    flask-cors otherwise compares the Origin header against each entry in turn.
+    "*" and an empty list are passed through unchanged.
+    """
+    if not origins or "*" in origins:
+        return origins
+    return re.compile("^(?:" + "|".join(re.escape(o) for o in origins) + ")$", re.IGNORECASE)
+
+
 app = Flask(__name__)
 CORS(app, resources={
     r"/*": {
-        "origins": FRONTEND_ORIGINS,
+        "origins": _origins_pattern(FRONTEND_ORIGINS),
         "methods": ["GET", "POST", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "X-ADMIN-TOKEN", "Authorization"],
     }
 })
 
 _AUTH = URLSafeTimedSerializer(AUTH_SECRET, salt="phishing-auth")
+_VALID_ROLES = frozenset(("admin", "user"))
+
+
+def ojson(obj, status: int = 200):
+    """Like jsonify(), but serialized with orjson (also handles numpy scalars)."""
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype="application/json",
+    )
 
 
 def _make_token(user_id: int, email: str, role: str, username: str | None = None) -> str:
@@ -108,38 +164,67 @@ def _get_bearer_token(req) -> str:
     auth = (req.headers.get("Authorization") or "").strip()
     if not auth:
         return ""
-    if auth.lower().startswith("bearer "):
+    if auth[:7].lower() == "bearer ":
         return auth[7:].strip()
     return ""
 
 
-def _require_auth(required_role: str | None = None) -> dict:
-    """Return auth context or abort(401/403)."""
-    token = _get_bearer_token(request)
-    if not token:
-        abort(401)
+@lru_cache(maxsize=4096)
+def _verify_token(token: str, bucket: int) -> tuple | None:
+    """Verified (user_id, email, username, role) for a bearer token, or None.
+
+    ``bucket`` is a 30-second time slot: repeated requests with the same token
+    skip the HMAC check within a slot, and entries stop matching once it ends.
+    """
     try:
         payload = _AUTH.loads(token, max_age=AUTH_TOKEN_TTL_SECONDS)
-    except SignatureExpired:
-        return abort(401)
-    except BadSignature:
-        return abort(401)
-
+    except (SignatureExpired, BadSignature):
+        return None
     user_id = payload.get("uid")
     email = str(payload.get("e") or "")
     username = str(payload.get("u") or email or "")
     role = str(payload.get("r") or "")
-    if user_id is None or role not in ("admin", "user"):
+    if user_id is None or role not in _VALID_ROLES:
+        return None
+    return int(user_id), email, username, role
+
+
+def _require_auth(required_role: str | None = None) -> dict:
+    """Return auth context or abort(401/403)."""
+    token = _get_bearer_token(request)
+    if not token:
+        abort(401)
+    verified = _verify_token(token, int(time.monotonic() // 30))
+    if verified is None:
         return abort(401)
+    user_id, email, username, role = verified
     if required_role and role != required_role:
         return abort(403)
-    return {"user_id": int(user_id), "email": email, "username": username, "role": role}
+    return {"user_id": user_id, "email": email, "username": username, "role": role}
+
+
+@app.before_request
+def _begin_db_scope():
+    # DB helpers called while handling one request share a pooled connection
+    begin_connection_scope()
+
+
+@app.teardown_request
+def _end_db_scope(exc):
+    end_connection_scope()
 
 
 def _is_admin_request() -> bool:
+    # Resolved once per request; later guards in the same request reuse it
+    if "is_admin" not in g:
+        g.is_admin = _check_admin_request()
+    return g.is_admin
+
+
+def _check_admin_request() -> bool:
     # Backward compat: allow existing admin token header (dev/demo)
     header_token = request.headers.get("X-ADMIN-TOKEN", "")
-    if ADMIN_TOKEN and header_token and hmac.compare_digest(header_token, ADMIN_TOKEN):
+    if ADMIN_TOKEN and header_token and hmac.compare_digest(header_token.encode(), ADMIN_TOKEN.encode()):
         return True
 
     # New: bearer token with admin role
@@ -152,6 +237,14 @@ def _is_admin_request() -> bool:
 MODEL = None
 MODEL_META = {"model_version": "none"}
 _AUTO_TRAIN_ATTEMPTED = False
+_INFERENCE_CACHE = None
+MODEL_COMPATIBLE = False  # _is_valid_pipeline(MODEL), refreshed by load_model()
+_RESP_TAIL = b""  # serialized model_version/model_accuracy members, refreshed by load_model()
+_MODEL_MTIME = None  # st_mtime_ns of MODEL_FILE when MODEL was loaded
+_HEALTH_BODY = None  # serialized /health response, rebuilt after each load_model()
+_RELOAD_CHECKED_AT = float("-inf")  # time.monotonic() of the last _check_model_file()
+_RELOAD_LOCK = threading.Lock()
+_CACHE_EPOCH = None  # st_mtime_ns of CACHE_EPOCH_FILE when this process last cleared its caches
 
 def _load_train_model():
     try:
@@ -162,12 +255,127 @@ def _load_train_model():
 
 def _is_valid_pipeline(model) -> bool:
     """Model must be a sklearn Pipeline with a DictVectorizer named 'vectorizer'."""
+    if model is None:
+        return False
+    from sklearn.feature_extraction import DictVectorizer
     try:
         ns = getattr(model, "named_steps", None)
         return bool(ns and isinstance(ns.get("vectorizer"), DictVectorizer))
     except Exception:
         return False
 
+def _build_inference_cache(model):
+    """Precompute the vectorizer's column layout so requests can skip DictVectorizer.transform.
+
+    Feature dicts are written straight into a dense row using the fitted vocabulary
+    and fed to the remaining pipeline steps (``model[1:]``).
+    """
+    vec = model.named_steps["vectorizer"]
+    # String features are one-hot columns named f"{key}{sep}{value}"; index them
+    # as key -> {value: column} so lookups need no string building per request
+    one_hot = {}
+    for name, col in vec.vocabulary_.items():
+        if isinstance(name, str) and vec.separator in name:
+            key, _, value = name.partition(vec.separator)
+            one_hot.setdefault(key, {})[value] = col
+    return {
+        "model": model,
+        "index": dict(vec.vocabulary_),
+        "one_hot": one_hot,
+        "separator": vec.separator,
+        "n_features": len(vec.feature_names_),
+        "dtype": vec.dtype,
+        "tail": model[1:],
+        "linear": _linear_head(model[1:]),
+    }
+
+
+def _linear_head(tail):
+    """Collapse ``tail`` into float32 (W, B) with P(class 1) = sigmoid(X @ W + B).
+
+    Only for a binary LogisticRegression on classes [0, 1], optionally preceded
+    by TruncatedSVD / StandardScaler steps (both affine, so they fold into W, B).
+    Returns None for anything else; those models go through the pipeline.
+    """
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.preprocessing import StandardScaler
+
+    clf = tail[-1]
+    if not isinstance(clf, LogisticRegression) or list(getattr(clf, "classes_", [])) != [0, 1]:
+        return None
+    A, c = None, None  # the preceding steps as one affine map: x -> x @ A + c
+    for _, step in tail.steps[:-1]:
+        if isinstance(step, TruncatedSVD):
+            M = step.components_.T
+            shift = np.zeros(M.shape[1])
+        elif isinstance(step, StandardScaler):
+            n = step.n_features_in_
+            scale = step.scale_ if step.scale_ is not None else np.ones(n)
+            mean = step.mean_ if step.with_mean else np.zeros(n)
+            M = np.diag(1.0 / scale)
+            shift = -mean / scale
+        elif step is None or step == "passthrough":
+            continue
+        else:
+            return None
+        A = M if A is None else A @ M
+        c = shift if c is None else c @ M + shift
+    w = clf.coef_.ravel()
+    b = float(clf.intercept_[0])
+    if A is None:
+        return w.astype(np.float32), b
+    return (A @ w).astype(np.float32), float(c @ w + b)
+
+
+def _load_onnx_session(model_path: Path):
+    """Open the ONNX sidecar written by train.export_onnx, if usable.
+
+    onnxruntime is optional; the sidecar is ignored unless it was exported from
+    the same model version as the loaded joblib file.
+    """
+    onnx_path = model_path.with_suffix(".onnx")
+    if not onnx_path.exists():
+        return None
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    try:
+        session = ort.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+    except Exception as exc:
+        app.logger.warning("Failed to load ONNX model %s: %s", onnx_path, exc)
+        return None
+    version = session.get_modelmeta().custom_metadata_map.get("model_version")
+    if version != str(MODEL_META.get("model_version")):
+        app.logger.warning("Ignoring stale ONNX model %s (version %s)", onnx_path, version)
+        return None
+    return session
+
+
+def _vectorize(cache, feature_rows):
+    """Equivalent of DictVectorizer.transform(feature_rows), as a dense array."""
+    index = cache["index"]
+    one_hot = cache["one_hot"]
+    sep = cache["separator"]
+    X = np.zeros((len(feature_rows), cache["n_features"]), dtype=cache["dtype"])
+    for row, features in enumerate(feature_rows):
+        for key, value in features.items():
+            if isinstance(value, str):
+                values_of_key = one_hot.get(key)
+                if values_of_key is not None:
+                    col = values_of_key.get(value)
+                else:
+                    # Key contains the separator itself (never indexed in one_hot)
+                    col = index.get(f"{key}{sep}{value}")
+                value = 1
+            else:
+                col = index.get(key)
+            if col is not None:
+                X[row, col] = value
+    return X
+
+
 def _try_auto_train():
     """Attempt a one-time auto-train using DEFAULT_DATA_PATH, then reload the model."""
     global _AUTO_TRAIN_ATTEMPTED
@@ -186,15 +394,29 @@ def _try_auto_train():
         app.logger.warning("Auto-train failed: %s", exc)
 
 def load_model():
-    global MODEL, MODEL_META, _AUTO_TRAIN_ATTEMPTED
+    global MODEL, MODEL_META, _AUTO_TRAIN_ATTEMPTED, _INFERENCE_CACHE, MODEL_COMPATIBLE, _RESP_TAIL, _MODEL_MTIME, _HEALTH_BODY
     p = Path(MODEL_FILE)
+    try:
+        mtime = p.stat().st_mtime_ns
+    except OSError:
+        mtime = None
+    if MODEL is not None and mtime is not None and mtime == _MODEL_MTIME:
+        # File unchanged since the last load; skip deserializing it again
+        return
+    _INFERENCE_CACHE = None
+    MODEL_COMPATIBLE = False
+    _MODEL_MTIME = None
+    _HEALTH_BODY = None
     if not p.exists():
         _try_auto_train()
         if not p.exists():
             MODEL = None
             MODEL_META = {"model_version": "none"}
             return
-    obj = joblib.load(p)
+    # joblib (and sklearn, via unpickling) are only imported once there is a model to load
+    import joblib
+
+    obj = joblib.load(p, mmap_mode=MODEL_MMAP_MODE)
     MODEL = obj.get("pipeline") if isinstance(obj, dict) else obj
     MODEL_META = obj.get("meta", {"model_version": p.stat().st_mtime})
     # Log model version and accuracy when loaded
@@ -213,33 +435,254 @@ def load_model():
         # Reload if a new model was produced
         if p.exists():
             try:
-                obj = joblib.load(p)
+                obj = joblib.load(p, mmap_mode=MODEL_MMAP_MODE)
                 MODEL = obj.get("pipeline") if isinstance(obj, dict) else obj
                 MODEL_META = obj.get("meta", {"model_version": p.stat().st_mtime})
             except Exception as exc:
                 app.logger.warning("Reload after auto-train failed: %s", exc)
+    _infer.cache_clear()
+    _MODEL_MTIME = p.stat().st_mtime_ns if MODEL is not None and p.exists() else None
+    _RESP_TAIL = orjson.dumps({
+        "model_version": MODEL_META.get("model_version"),
+        "model_accuracy": MODEL_META.get("accuracy"),
+    }, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1]
+    MODEL_COMPATIBLE = _is_valid_pipeline(MODEL)
+    _HEALTH_BODY = None  # again, in case /health cached a mid-reload state
+    if MODEL_COMPATIBLE:
+        _INFERENCE_CACHE = _build_inference_cache(MODEL)
+        session = _load_onnx_session(p)
+        if session is not None:
+            _INFERENCE_CACHE["onnx"] = session
+            _INFERENCE_CACHE["onnx_input"] = session.get_inputs()[0].name
+            app.logger.info("Serving predictions through onnxruntime")
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _clear_url_caches():
+    _extract_cached.cache_clear()
+    _infer.cache_clear()
+
+
+def _check_model_file():
+    """Pick up work done by other worker processes, at most once per MODEL_RELOAD_CHECK_SECONDS.
+
+    POST /train and POST /admin/cache/clear only run in the worker that served
+    them; the others notice the new MODEL_FILE / CACHE_EPOCH_FILE mtime here.
+    """
+    global _RELOAD_CHECKED_AT, _CACHE_EPOCH
+    if MODEL_RELOAD_CHECK_SECONDS <= 0:
+        return
+    if time.monotonic() - _RELOAD_CHECKED_AT < MODEL_RELOAD_CHECK_SECONDS:
+        return
+    # One thread checks; the others keep serving instead of waiting on it
+    if not _RELOAD_LOCK.acquire(blocking=False):
+        return
+    try:
+        _RELOAD_CHECKED_AT = time.monotonic()
+        epoch = _file_mtime(CACHE_EPOCH_FILE)
+        if epoch != _CACHE_EPOCH:
+            _CACHE_EPOCH = epoch
+            _clear_url_caches()
+        mtime = _file_mtime(MODEL_FILE)
+        # A missing file is left alone: auto-training never runs in a request
+        if mtime is not None and mtime != _MODEL_MTIME:
+            try:
+                load_model()
+            except Exception as exc:
+                app.logger.warning("Reloading retrained model failed: %s", exc)
+    finally:
+        _RELOAD_LOCK.release()
+
+# ---------------- Micro-batched inference ---------------- #
+# Concurrent /predict requests are coalesced into a single predict/predict_proba
+# call so the pipeline's per-call overhead is paid once per batch, not per URL.
+_PREDICT_Q = queue.Queue()
+_PREDICT_WORKER = None
+_PREDICT_WORKER_LOCK = threading.Lock()
+_PREDICT_INFLIGHT = 0  # requests currently inside _predict_one
+_PREDICT_INFLIGHT_LOCK = threading.Lock()
+
+
+def _predict_batch(feature_rows):
+    """Run the model once over a list of feature dicts -> [(pred, proba), ...]."""
+    model = MODEL
+    cache = _INFERENCE_CACHE
+    X = feature_rows
+    if cache is not None and cache["model"] is model:
+        X = _vectorize(cache, feature_rows)
+        linear = cache["linear"]
+        if linear is not None:
+            from scipy.special import expit
+
+            W, B = linear
+            z = X.astype(np.float32, copy=False) @ W + B
+            return [(int(zi > 0), float(p)) for zi, p in zip(z, expit(z))]
+        session = cache.get("onnx")
+        if session is not None:
+            labels, probs = session.run(None, {cache["onnx_input"]: X.astype(np.float32, copy=False)})
+            return [(int(pred), float(proba)) for pred, proba in zip(labels, probs[:, 1])]
+        model = cache["tail"]
+    from sklearn import config_context
+
+    # Features come from extract_features and are always finite, so skip
+    # sklearn's per-call NaN/inf scan. set_config() is thread-local and would not
+    # reach this worker thread, hence the context manager.
+    with config_context(assume_finite=True):
+        if hasattr(model, "predict_proba"):
+            # One pass: the label is the argmax of the probabilities (what
+            # predict() computes internally for these classifiers)
+            P = model.predict_proba(X)
+            preds = model.classes_.take(P.argmax(axis=1))
+            probs = [float(p) for p in P[:, 1]]
+        else:
+            preds = model.predict(X)
+            probs = [None] * len(feature_rows)
+    return [(int(pred), proba) for pred, proba in zip(preds, probs)]
+
+
+def _predict_worker():
+    while True:
+        batch = [_PREDICT_Q.get()]
+        deadline = time.monotonic() + PREDICT_BATCH_WAIT_MS / 1000.0
+        while len(batch) < PREDICT_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_PREDICT_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            results = _predict_batch([features for features, _ in batch])
+        except Exception as exc:
+            for _, slot in batch:
+                slot["error"] = exc
+                slot["done"].set()
+            continue
+        for (_, slot), result in zip(batch, results):
+            slot["result"] = result
+            slot["done"].set()
+
+
+def _ensure_predict_worker():
+    """Start the batching thread lazily (and again in forked worker processes)."""
+    global _PREDICT_WORKER
+    if _PREDICT_WORKER is not None and _PREDICT_WORKER.is_alive():
+        return
+    with _PREDICT_WORKER_LOCK:
+        if _PREDICT_WORKER is None or not _PREDICT_WORKER.is_alive():
+            _PREDICT_WORKER = threading.Thread(target=_predict_worker, name="predict-batcher", daemon=True)
+            _PREDICT_WORKER.start()
+
+
+def _predict_one(features: dict):
+    """Predict one feature dict -> (pred, proba).
+
+    With no other prediction in flight there is nothing to batch with, so the
+    model runs inline instead of paying the queue hand-off and batch wait.
+    Otherwise the request joins the batching queue.
+    """
+    global _PREDICT_INFLIGHT
+    with _PREDICT_INFLIGHT_LOCK:
+        _PREDICT_INFLIGHT += 1
+        alone = _PREDICT_INFLIGHT == 1
+    try:
+        if alone:
+            return _predict_batch([features])[0]
+        _ensure_predict_worker()
+        slot = {"done": threading.Event(), "result": None, "error": None}
+        _PREDICT_Q.put((features, slot))
+        if not slot["done"].wait(timeout=PREDICT_TIMEOUT_SECONDS):
+            raise TimeoutError("prediction timed out waiting for the batch worker")
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["result"]
+    finally:
+        with _PREDICT_INFLIGHT_LOCK:
+            _PREDICT_INFLIGHT -= 1
+
+
+def _compile_host_rules(allow, block):
+    """One alternation anchored at the end of the host; None when both lists are empty.
+
+    The earliest match position is the longest matching suffix, so a blocked
+    subdomain of an allowed domain is still blocked (and vice versa).
+    """
+    if not allow and not block:
+        return None
+    parts = []
+    if block:
+        parts.append("(?P<block>" + "|".join(re.escape(d) for d in block) + ")")
+    if allow:
+        parts.append("(?P<allow>" + "|".join(re.escape(d) for d in allow) + ")")
+    return re.compile(r"(?:^|\.)(?:" + "|".join(parts) + r")$")
+
+
+_HOST_RULES = _compile_host_rules(URL_ALLOWLIST, URL_BLOCKLIST)
+
+
+def _host_rule(url: str):
+    """Return "allow", "block" or None for the URL's host."""
+    if _HOST_RULES is None:
+        return None
+    try:
+        host = urlsplit(url if "://" in url else "http://" + url).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    m = _HOST_RULES.search(host.rstrip("."))
+    return m.lastgroup if m else None
+
+
+@lru_cache(maxsize=FEATURE_CACHE_SIZE)
+def _extract_cached(url: str) -> dict:
+    """Memoized extract_features; callers must copy the dict before mutating it."""
+    return extract_features(url)
+
+
+@lru_cache(maxsize=PREDICT_CACHE_SIZE)
+def _infer(url: str) -> tuple:
+    """Memoized features + prediction per URL; cleared whenever the model reloads."""
+    features = _extract_cached(url)
+    pred, proba = _predict_one(features)
+    return features, pred, proba
+
 
 load_model()
 
 @app.route("/health", methods=["GET"])
 def health():
-    has_register_route = False
-    try:
-        has_register_route = any(r.rule == "/auth/register" for r in app.url_map.iter_rules())
-    except Exception:
+    global _HEALTH_BODY
+    _check_model_file()
+    # Everything below only changes on model (re)load, which resets the cache
+    body = _HEALTH_BODY
+    if body is None:
         has_register_route = False
-    return jsonify({
-        "status": "ok",
-        "model_loaded": MODEL is not None,
-        "model_version": MODEL_META.get("model_version"),
-        "model_compatible": bool(_is_valid_pipeline(MODEL)) if MODEL is not None else False,
-        "model_accuracy": MODEL_META.get("accuracy"),  # added
-        "has_register_route": bool(has_register_route),
-    })
+        try:
+            has_register_route = any(r.rule == "/auth/register" for r in app.url_map.iter_rules())
+        except Exception:
+            has_register_route = False
+        body = _HEALTH_BODY = orjson.dumps({
+            "status": "ok",
+            "model_loaded": MODEL is not None,
+            "model_version": MODEL_META.get("model_version"),
+            "model_compatible": MODEL_COMPATIBLE,
+            "model_accuracy": MODEL_META.get("accuracy"),  # added
+            "has_register_route": bool(has_register_route),
+        }, option=orjson.OPT_SERIALIZE_NUMPY)
+    return app.response_class(body, mimetype="application/json")
+
+_SCHEMA_BODY = orjson.dumps(features_schema())
 
 @app.route("/features/schema", methods=["GET"])
 def schema():
-    return jsonify(features_schema())
+    return app.response_class(_SCHEMA_BODY, mimetype="application/json")
 
 
 @app.route("/auth/login", methods=["POST"])
@@ -336,22 +779,58 @@ def client_info():
         "user_agent": ua,
     })
 
-@app.route("/predict", methods=["POST"])
-def predict():
-    data = request.get_json(force=True)
-    if not data or "url" not in data:
-        return jsonify({"error": "missing 'url' in payload"}), 400
+_TS_SEC = 0
+_TS_STR = ""
+
+
+def _now_iso() -> str:
+    """Current UTC time as an ISO-8601 string, formatted at most once per second."""
+    global _TS_SEC, _TS_STR
+    sec = time.time_ns() // 1_000_000_000
+    if sec != _TS_SEC:
+        # Assign the string first so a concurrent reader never pairs the new
+        # second with the previous second's text
+        _TS_STR = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))
+        _TS_SEC = sec
+    return _TS_STR
+
+
+def _log_prediction(url: str, features: dict, **fields) -> int | None:
+    """Log one /predict result; returns the row id only with DB_LOG_SYNC.
+
+    By default the row is queued for the background writer and None is returned.
+    """
+    if LOG_SYNC:
+        try:
+            return insert_prediction(url, features, **fields)
+        except Exception as exc:
+            app.logger.warning("Failed to log prediction: %s", exc)
+            return None
+    if not enqueue_prediction(url, features, **fields):
+        app.logger.warning("Prediction log queue full; dropping entry")
+    return None
+
+
+def _parse_predict(data: dict) -> tuple[str, str, str, dict]:
+    """Request payload -> (url, device, ip, metadata) for /predict."""
     url = str(data.get("url"))[:MAX_URL_LENGTH]
     # Always derive client info server-side; do not trust client-provided device/ip
     ua = request.headers.get("User-Agent", "")
-    device = _device_from_user_agent(ua)
-    ip = _get_client_ip(request)
-    metadata = data.get("metadata", {}) or {}
+    metadata = data.get("metadata") or {}
+    if not isinstance(metadata, dict):
+        metadata = {}
     metadata.setdefault("user_agent", ua)
-    metadata.setdefault("timestamp", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
-    if len(url) > MAX_URL_LENGTH:
-        return jsonify({"error": "url too long"}), 400
-    features = extract_features(url)
+    metadata.setdefault("timestamp", _now_iso())
+    return url, _device_from_user_agent(ua), _get_client_ip(request), metadata
+
+
+@app.route("/predict", methods=["POST"])
+def predict():
+    data = request.get_json(force=True)
+    if not data or "url" not in data:
+        return ojson({"error": "missing 'url' in payload"}, 400)
+    url, device, ip, metadata = _parse_predict(data)
+    _check_model_file()
     # If user is logged in, attach ownership to the log entry; otherwise keep anonymous
     owner_username = "anonymous"
     owner_user_id = None
@@ -364,24 +843,48 @@ def predict():
     except Exception:
         owner_username = "anonymous"
         owner_user_id = None
+    rule = _host_rule(url)
+    if rule is not None:
+        # Decided by URL_ALLOWLIST/URL_BLOCKLIST: skip feature extraction and the model
+        pred = 1 if rule == "block" else 0
+        log_id = _log_prediction(
+            url,
+            {},
+            prediction=pred,
+            probability=float(pred),
+            device=device,
+            ip=ip,
+            metadata={**metadata, "rule": rule},
+            model_version=str(MODEL_META.get("model_version")),
+            owner_username=owner_username,
+            owner_user_id=owner_user_id,
+        )
+        return ojson({
+            "prediction": "phishing" if pred else "legitimate",
+            "probability": float(pred),
+            "features": {},
+            "rule": rule,
+            "device": device,
+            "ip": ip,
+            "model_version": MODEL_META.get("model_version"),
+            "model_accuracy": MODEL_META.get("accuracy"),
+            "log_id": log_id
+        })
     if MODEL is None:
-        try:
-            log_id = insert_prediction(
-                url,
-                features,
-                prediction=-1,
-                probability=-1.0,
-                device=device,
-                ip=ip,
-                metadata=metadata,
-                model_version=str(MODEL_META.get("model_version")),
-                owner_username=owner_username,
-                owner_user_id=owner_user_id,
-            )
-        except Exception as exc:
-            app.logger.warning("Failed to log prediction (model missing): %s", exc)
-            log_id = None
-        return jsonify({
+        features = dict(_extract_cached(url))
+        log_id = _log_prediction(
+            url,
+            features,
+            prediction=-1,
+            probability=-1.0,
+            device=device,
+            ip=ip,
+            metadata=metadata,
+            model_version=str(MODEL_META.get("model_version")),
+            owner_username=owner_username,
+            owner_user_id=owner_user_id,
+        )
+        return ojson({
             "prediction": "model_not_loaded",
             "probability": None,
             "features": features,
@@ -391,58 +894,56 @@ def predict():
             "model_accuracy": MODEL_META.get("accuracy"),  # added
             "log_id": log_id,
             "message": "No trained model available. Train model via POST /train."
-        }), 200
+        }, 200)
     # New: validate model compatibility before calling predict
-    if not _is_valid_pipeline(MODEL):
-        return jsonify({
+    if not MODEL_COMPATIBLE:
+        return ojson({
             "error": "incompatible model file: expected a sklearn Pipeline with a DictVectorizer step named 'vectorizer'. Retrain the backend via POST /train.",
             "error_type": "ModelIncompatibleError",
             "model_type": str(type(MODEL)),
             "model_version": MODEL_META.get("model_version"),
             "remedy": "Trigger retraining from the UI or call POST /train; ensure new model overwrites the old file."
-        }), 500
+        }, 500)
     try:
-        pred = MODEL.predict([features])[0]
-        proba = float(MODEL.predict_proba([features])[0][1]) if hasattr(MODEL, "predict_proba") else None
+        features, pred, proba = _infer(url)
+        features = dict(features)
     except Exception as e:
-        import traceback
-        return jsonify({
+        app.logger.error("Model prediction failed: %s", e, exc_info=LOG_TRACEBACKS)
+        body = {
             "error": f"model prediction failed: {str(e)}",
             "error_type": e.__class__.__name__,
-            "traceback": traceback.format_exc(),
-        }), 500
+        }
+        if LOG_TRACEBACKS or app.debug:
+            body["traceback"] = traceback.format_exc()
+        return ojson(body, 500)
     label = "phishing" if int(pred) == 1 else "legitimate"
-    try:
-        log_id = insert_prediction(
-            url,
-            features,
-            prediction=int(pred),
-            probability=proba or 0.0,
-            device=device,
-            ip=ip,
-            metadata=metadata,
-            model_version=str(MODEL_META.get("model_version")),
-            owner_username=owner_username,
-            owner_user_id=owner_user_id,
-        )
-    except Exception as exc:
-        app.logger.warning("Failed to log prediction: %s", exc)
-        log_id = None
-    return jsonify({
+    log_id = _log_prediction(
+        url,
+        features,
+        prediction=int(pred),
+        probability=proba or 0.0,
+        device=device,
+        ip=ip,
+        metadata=metadata,
+        model_version=str(MODEL_META.get("model_version")),
+        owner_username=owner_username,
+        owner_user_id=owner_user_id,
+    )
+    # Same body as ojson({...}) with the per-model members spliced in pre-serialized
+    head = orjson.dumps({
         "prediction": label,
         "probability": proba,
         "features": features,
         "device": device,
         "ip": ip,
-        "model_version": MODEL_META.get("model_version"),
-        "model_accuracy": MODEL_META.get("accuracy"),  # added
-        "log_id": log_id
     })
+    body = b"".join((head[:-1], b",", _RESP_TAIL, b',"log_id":', orjson.dumps(log_id), b"}"))
+    return app.response_class(body, mimetype="application/json")
 
 @app.route("/train", methods=["POST"])
 def train_endpoint():
     if not _is_admin_request():
-        return jsonify({"error": "unauthorized"}), 401
+        return ojson({"error": "unauthorized"}, 401)
     data = request.get_json(silent=True) or {}
     data_path = data.get("data_path")
     grid = data.get("grid", False)
@@ -450,43 +951,65 @@ def train_endpoint():
     try:
         train_model = _load_train_model()
     except MemoryError:
-        return jsonify({"error": "insufficient memory to import training pipeline"}), 500
+        return ojson({"error": "insufficient memory to import training pipeline"}, 500)
     try:
         # Call training with structured-error mode
         result = train_model(data_path, perform_gridsearch=grid, label_column=label_column, raise_errors=False)
         # If training returned an error payload, propagate it clearly
         if isinstance(result, dict) and "error" in result:
             status = 400 if result.get("error_type") in ("FileNotFoundError", "ValueError") else 500
-            return jsonify({
+            return ojson({
                 "error": result.get("error"),
                 "error_type": result.get("error_type"),
                 "traceback": result.get("traceback"),
             }), status
         load_model()
-        return jsonify({"status": "trained", "meta": result.get("meta", {}), "test_predictions_csv": result.get("test_predictions")})
+        return ojson({
+            "status": "trained",
+            "meta": result.get("meta", {}),
+            "test_predictions_csv": result.get("test_predictions"),
+            "onnx": result.get("onnx"),
+            "onnx_error": result.get("onnx_error"),
+        })
     except Exception as e:
-        return jsonify({"error": f"training failed: {str(e)}"}), 500
+        return ojson({"error": f"training failed: {str(e)}"}, 500)
+
+@app.route("/admin/cache/clear", methods=["POST"])
+def admin_cache_clear():
+    """Drop the feature and prediction caches of every worker (e.g. after changing features.py)."""
+    if not _is_admin_request():
+        return ojson({"error": "unauthorized"}, 401)
+    global _CACHE_EPOCH
+    _clear_url_caches()
+    # Tell the other workers, which compare this file's mtime in _check_model_file()
+    try:
+        Path(CACHE_EPOCH_FILE).parent.mkdir(parents=True, exist_ok=True)
+        Path(CACHE_EPOCH_FILE).write_text(str(time.time_ns()))
+        _CACHE_EPOCH = _file_mtime(CACHE_EPOCH_FILE)
+    except OSError as exc:
+        app.logger.warning("Could not signal cache clear to other workers: %s", exc)
+    return ojson({"status": "cleared"})
 
 @app.route("/logs", methods=["GET", "DELETE"])
 def logs():
     if request.method == "DELETE":
         # Admin only: clear all logs
         if not _is_admin_request():
-            return jsonify({"error": "unauthorized"}), 401
+            return ojson({"error": "unauthorized"}, 401)
         try:
             user_id_filter = (request.args.get("user_id") or "").strip()
             username_filter = (request.args.get("username") or "").strip()
             if user_id_filter:
                 deleted = delete_logs_for_user_id(int(user_id_filter))
-                return jsonify({"status": "cleared", "deleted": deleted, "scope": "user_id", "user_id": int(user_id_filter)})
+                return ojson({"status": "cleared", "deleted": deleted, "scope": "user_id", "user_id": int(user_id_filter)})
             if username_filter:
                 deleted = delete_logs_for_user(username_filter)
-                return jsonify({"status": "cleared", "deleted": deleted, "scope": "user", "username": username_filter})
+                return ojson({"status": "cleared", "deleted": deleted, "scope": "user", "username": username_filter})
             deleted = clear_logs()
-            return jsonify({"status": "cleared", "deleted": deleted, "scope": "all"})
+            return ojson({"status": "cleared", "deleted": deleted, "scope": "all"})
         except Exception as exc:
             app.logger.error("Clearing logs failed: %s", exc)
-            return jsonify({"error": "database_unavailable"}), 503
+            return ojson({"error": "database_unavailable"}, 503)
 
     # GET requires any authenticated user
     ctx = _require_auth(required_role=None)
@@ -496,16 +1019,20 @@ def logs():
         username_filter = (request.args.get("username") or "").strip()
         if ctx.get("role") == "admin":
             if user_id_filter:
-                return jsonify(get_recent_for_user_id(int(user_id_filter), limit=limit))
-            if username_filter:
-                return jsonify(get_recent_for_user(username_filter, limit=limit))
-            return jsonify(get_recent(limit=limit))
-        if ctx.get("user_id") is not None:
-            return jsonify(get_recent_for_user_id(int(ctx.get("user_id")), limit=limit))
-        return jsonify(get_recent_for_user(ctx.get("email") or ctx.get("username"), limit=limit))
+                body = get_recent_for_user_id_json(int(user_id_filter), limit=limit)
+            elif username_filter:
+                body = get_recent_for_user_json(username_filter, limit=limit)
+            else:
+                body = get_recent_json(limit=limit)
+        elif ctx.get("user_id") is not None:
+            body = get_recent_for_user_id_json(int(ctx.get("user_id")), limit=limit)
+        else:
+            body = get_recent_for_user_json(ctx.get("email") or ctx.get("username"), limit=limit)
+        # Already-serialized JSON array (stored feature/metadata JSON is not re-parsed)
+        return app.response_class(body, mimetype="application/json")
     except Exception as exc:
         app.logger.error("Fetching logs failed: %s", exc)
-        return jsonify({"error": "database_unavailable"}), 503
+        return ojson({"error": "database_unavailable"}, 503)
 
 
 @app.route("/logs/mine", methods=["DELETE"])
@@ -550,7 +1077,7 @@ def admin_users():
     username = (str(data.get("username") or "").strip())
     password = str(data.get("password") or "")
     role = (str(data.get("role") or "user").strip() or "user")
-    if role not in ("user", "admin"):
+    if role not in _VALID_ROLES:
         return jsonify({"error": "invalid role"}), 400
     if not (email or username) or not password:
         return jsonify({"error": "missing email/password"}), 400
@@ -569,7 +1096,7 @@ def admin_change_role(username: str):
         return jsonify({"error": "unauthorized"}), 401
     data = request.get_json(silent=True) or {}
     role = (str(data.get("role") or "").strip())
-    if role not in ("user", "admin"):
+    if role not in _VALID_ROLES:
         return jsonify({"error": "invalid role"}), 400
     try:
         set_user_role(username, role)
@@ -585,7 +1112,7 @@ def admin_change_role_by_id(user_id: int):
         return jsonify({"error": "unauthorized"}), 401
     data = request.get_json(silent=True) or {}
     role = (str(data.get("role") or "").strip())
-    if role not in ("user", "admin"):
+    if role not in _VALID_ROLES:
         return jsonify({"error": "invalid role"}), 400
     try:
         set_user_role(int(user_id), role)
@@ -621,7 +1148,7 @@ def admin_user_logs_by_id(user_id: int):
         if request.method == "DELETE":
             deleted = delete_logs_for_user_id(int(user_id))
             return jsonify({"status": "cleared", "deleted": deleted, "scope": "user_id", "user_id": int(user_id)})
-        return jsonify(get_recent_for_user_id(int(user_id), limit=limit))
+        return app.response_class(get_recent_for_user_id_json(int(user_id), limit=limit), mimetype="application/json")
     except Exception as exc:
         app.logger.error("Admin user logs failed: %s", exc)
         return jsonify({"error": "database_unavailable"}), 503
@@ -631,5 +1158,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="0.0.0.0")
     parser.add_argument("--port", default=8081, type=int)
+    parser.add_argument("--debug", action="store_true", help="Enable Flask debug mode (dev only)")
     args = parser.parse_args()
-    app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
+    # Dev server only; use `gunicorn -c gunicorn_conf.py app:app` in production.
+    # Threaded so blocking DB round trips in one request overlap with others
+    app.run(host=args.host, port=args.port, debug=args.debug, use_reloader=False, threaded=True)
@@ -5,6 +5,8 @@ from config import DEFAULT_DATA_PATH
 
 LABEL_ALIASES = ["label", "target", "class", "status", "result", "phishing"]
 URL_ALIASES = ["url", "URL", "Url", "link", "Link"]
+POSITIVE_LABELS = frozenset(("1", "phishing", "malicious", "yes", "true"))
+NEGATIVE_LABELS = frozenset(("0", "legitimate", "benign", "no", "false"))
 
 def normalize_label(v):
     if v is None:
@@ -14,9 +16,9 @@ def normalize_label(v):
         if not s:
             return None
         s_low = s.lower()
-        if s_low in ("1", "phishing", "malicious", "yes", "true"):
+        if s_low in POSITIVE_LABELS:
             return 1
-        if s_low in ("0", "legitimate", "benign", "no", "false"):
+        if s_low in NEGATIVE_LABELS:
             return 0
         try:
             iv = int(float(s_low))
@@ -36,10 +38,11 @@ def load_dataset(path: Optional[str] = None, label_column: str = "label") -> Lis
     if not p.exists():
         raise FileNotFoundError(f"Dataset not found at {p}. See README for how to download a public dataset.")
     with p.open(newline="", encoding="utf-8-sig") as fh:
-        reader = csv.DictReader(fh)
-        if not reader.fieldnames:
+        reader = csv.reader(fh)
+        names = next(reader, None)
+        if not names:
             raise ValueError("Dataset must contain headers.")
-        field_map = {name.lower(): name for name in reader.fieldnames}
+        field_map = {name.lower(): name for name in names}
         url_key = next((field_map.get(alias.lower()) for alias in URL_ALIASES if alias.lower() in field_map), None)
         if not url_key:
             raise ValueError(f"Dataset must contain a URL column (one of: {', '.join(URL_ALIASES)}).")
@@ -47,12 +50,25 @@ def load_dataset(path: Optional[str] = None, label_column: str = "label") -> Lis
         label_key = next((field_map.get(alias.lower()) for alias in candidate_labels if alias.lower() in field_map), None)
         if not label_key:
             raise ValueError("Dataset must contain a label column. Tried: " + ", ".join(candidate_labels))
+        # Rows are indexed by column position (no dict per row). A duplicated
+        # header name resolves to its last column, as csv.DictReader did.
+        url_idx = len(names) - 1 - names[::-1].index(url_key)
+        label_idx = len(names) - 1 - names[::-1].index(label_key)
+        # Label columns hold a handful of distinct strings: normalize each once
+        labels: Dict[Optional[str], Optional[int]] = {}
         records: List[Dict[str, Any]] = []
         for row in reader:
-            raw_url = (row.get(url_key) or "").strip()
+            n = len(row)
+            if not n:
+                continue
+            raw_url = row[url_idx].strip() if url_idx < n else ""
             if not raw_url:
                 continue
-            norm_label = normalize_label(row.get(label_key))
+            raw_label = row[label_idx] if label_idx < n else None
+            if raw_label in labels:
+                norm_label = labels[raw_label]
+            else:
+                norm_label = labels[raw_label] = normalize_label(raw_label)
             if norm_label is None:
                 continue
             records.append({"url": raw_url, "label": norm_label})
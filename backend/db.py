@@ -1,11 +1,15 @@
 import os
 import json
 import time
+import atexit
+import queue
+import random
+import logging
 import threading
 from config import LOG_FULL_URLS
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from config import ADMIN_USERNAME, ADMIN_PASSWORD, USER_USERNAME, USER_PASSWORD
+from config import ADMIN_USERNAME, ADMIN_PASSWORD, USER_USERNAME, USER_PASSWORD, BCRYPT_ROUNDS
 
 try:
     import bcrypt
@@ -15,7 +19,7 @@ except ImportError as exc:
 
 def _hash_password(password: str) -> str:
     pw = (password or "").encode("utf-8")
-    hashed = bcrypt.hashpw(pw, bcrypt.gensalt(rounds=12))
+    hashed = bcrypt.hashpw(pw, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
     return hashed.decode("utf-8")
 
 
@@ -24,11 +28,23 @@ def _is_bcrypt_hash(password_hash: str) -> bool:
     return ph.startswith("$2a$") or ph.startswith("$2b$") or ph.startswith("$2y$")
 
 
+def _bcrypt_cost(password_hash: str) -> int | None:
+    """Work factor embedded in a $2a$/$2b$/$2y$ hash ("$2b$12$..." -> 12)."""
+    parts = (password_hash or "").strip().split("$")
+    if len(parts) < 4 or parts[1] not in ("2a", "2b", "2y") or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
 def _verify_password(password_hash: str, password: str) -> bool:
     ph = (password_hash or "").strip()
     if not ph:
         return False
     if _is_bcrypt_hash(ph):
+        # A bcrypt hash is always "$2b$NN$" + 53 chars; reject anything else
+        # (truncated/corrupt rows) without running the key setup
+        if len(ph) != 60 or ph[6] != "$" or not ph[4:6].isdigit():
+            return False
         try:
             return bcrypt.checkpw((password or "").encode("utf-8"), ph.encode("utf-8"))
         except Exception:
@@ -39,8 +55,42 @@ def _verify_password(password_hash: str, password: str) -> bool:
     except Exception:
         return False
 
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is used when orjson is missing
+    orjson = None
+
+
+def _dumps(obj) -> str:
+    """JSON text for the *_json columns (orjson when available)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # e.g. integers beyond 64 bits in client-supplied metadata
+            pass
+    return json.dumps(obj)
+
+
+def _loads(text):
+    """Parse a *_json column value (JSON or LONGTEXT column); empty/NULL -> {}."""
+    if not text:
+        return {}
+    if isinstance(text, dict):
+        # Already decoded by the driver
+        return text
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            # Rows written by json.dumps may contain NaN/Infinity literals
+            pass
+    return json.loads(text)
+
 try:
     import mysql.connector as mysql_connector
+    from mysql.connector import pooling as mysql_pooling
+    from mysql.connector.constants import FieldType as mysql_field_type
 except ImportError as exc:
     raise RuntimeError("mysql-connector-python package is required for the database layer") from exc
 
@@ -54,25 +104,170 @@ MYSQL_CONFIG = {
 PREDICTIONS_TABLE = os.getenv("DB_TABLE", "predictions")
 PERMISSIONS_TABLE = os.getenv("DB_PERMISSIONS_TABLE", "user_permissions")
 USERS_TABLE = os.getenv("DB_USERS_TABLE", "users")
+SCHEMA_META_TABLE = os.getenv("DB_SCHEMA_META_TABLE", "schema_meta")
+# Bump whenever init_db() gains a table, column, index or data migration:
+# databases already stamped with this version skip init_db()'s probes entirely
+SCHEMA_VERSION = 3
+
+# Prediction log statements, built once (table names are fixed at import)
+_INSERT_PREDICTION_SQL = (
+    f"INSERT INTO {PREDICTIONS_TABLE} "
+    "(owner_user_id, owner_username, url, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+)
+_SELECT_PREDICTIONS_SQL = (
+    "SELECT id, owner_user_id, owner_username, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp "
+    f"FROM {PREDICTIONS_TABLE} "
+)
+_RECENT_SQL = _SELECT_PREDICTIONS_SQL + "ORDER BY id DESC LIMIT %s"
+_RECENT_FOR_USER_SQL = _SELECT_PREDICTIONS_SQL + "WHERE owner_username=%s ORDER BY id DESC LIMIT %s"
+_RECENT_FOR_USER_ID_SQL = _SELECT_PREDICTIONS_SQL + "WHERE owner_user_id=%s ORDER BY id DESC LIMIT %s"
+
+# users columns in select order; rows become dicts via dict(zip(_USER_COLS, row))
+_USER_COLS = (
+    "id", "email", "username", "password_hash", "role", "can_delete_own_logs",
+    "last_login_ip", "last_login_device", "created_at", "last_login_at",
+)
+_SELECT_USER_SQL = {
+    col: f"SELECT {', '.join(_USER_COLS)} FROM {USERS_TABLE} WHERE {col}=%s"
+    for col in ("id", "username", "email")
+}
+# list_users never exposes password hashes
+_LIST_USER_COLS = tuple(col for col in _USER_COLS if col != "password_hash")
+_LIST_USERS_SQL = f"SELECT {', '.join(_LIST_USER_COLS)} FROM {USERS_TABLE} ORDER BY email ASC"
+_INSERT_USER_SQL = (
+    f"INSERT INTO {USERS_TABLE} (email, username, password_hash, role, can_delete_own_logs, created_at, last_login_at) "
+    "VALUES (%s,%s,%s,%s,%s,%s,%s)"
+)
+# User updates addressed by id or by username, see _user_key()
+_SET_ROLE_SQL = {col: f"UPDATE {USERS_TABLE} SET role=%s WHERE {col}=%s" for col in ("id", "username")}
+_SET_PASSWORD_SQL = {col: f"UPDATE {USERS_TABLE} SET password_hash=%s WHERE {col}=%s" for col in ("id", "username")}
+_RECORD_LOGIN_SQL = {
+    col: f"UPDATE {USERS_TABLE} SET last_login_ip=%s, last_login_device=%s, last_login_at=%s WHERE {col}=%s"
+    for col in ("id", "username")
+}
+_SET_CAN_DELETE_SQL = f"UPDATE {USERS_TABLE} SET can_delete_own_logs=%s WHERE id=%s"
+_UPSERT_PERMISSION_SQL = (
+    f"INSERT INTO {PERMISSIONS_TABLE} (username, can_delete_own_logs, updated_at) VALUES (%s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE can_delete_own_logs=VALUES(can_delete_own_logs), updated_at=VALUES(updated_at)"
+)
+_SELECT_PERMISSION_SQL = f"SELECT can_delete_own_logs FROM {PERMISSIONS_TABLE} WHERE username=%s"
+_DELETE_ALL_LOGS_SQL = f"DELETE FROM {PREDICTIONS_TABLE}"
+_DELETE_LOGS_FOR_USER_SQL = f"DELETE FROM {PREDICTIONS_TABLE} WHERE owner_username=%s"
+_DELETE_LOGS_FOR_USER_ID_SQL = f"DELETE FROM {PREDICTIONS_TABLE} WHERE owner_user_id=%s"
+
+# mysql-connector uses its C extension (protocol decoding in C) whenever it is
+# installed; DB_USE_PURE=true forces the pure-Python implementation
+USE_PURE = os.getenv("DB_USE_PURE", "false").lower() in ("1", "true", "yes")
 
 RETRY_ATTEMPTS = int(os.getenv("DB_CONNECT_RETRIES", "5"))
 RETRY_DELAY_SECONDS = float(os.getenv("DB_CONNECT_RETRY_DELAY", "1.5"))
-
-_schema_ready = False
+RETRY_MAX_DELAY_SECONDS = 30.0
+# Connections per process kept open by the pool (mysql-connector allows at most 32).
+# The pool opens all of them up front, so the default matches what one gunicorn
+# worker can use: one per request thread (GUNICORN_THREADS) plus one spare.
+POOL_SIZE = max(1, min(
+    int(os.getenv("DB_POOL_SIZE") or int(os.getenv("GUNICORN_THREADS", "4")) + 1),
+    mysql_pooling.CNX_POOL_MAXSIZE,
+))
+# The autocommit pool for reads (/logs, user lookups) is kept small: those
+# queries are short, and a busy pool overflows to direct connections
+RO_POOL_SIZE = max(1, min(int(os.getenv("DB_RO_POOL_SIZE", "2")), mysql_pooling.CNX_POOL_MAXSIZE))
+# Direct connections a process may open beyond its pools when they are all
+# borrowed; past that, callers wait up to DB_POOL_TIMEOUT seconds for one
+POOL_OVERFLOW = max(0, int(os.getenv("DB_POOL_OVERFLOW", "2")))
+POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# Prediction logging is buffered and written in batches by a background thread
+LOG_QUEUE_SIZE = int(os.getenv("DB_LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("DB_LOG_BATCH_SIZE", "256"))
+# After the first row arrives, wait up to this long for more before writing
+LOG_LINGER_SECONDS = float(os.getenv("DB_LOG_LINGER_MS", "20")) / 1000.0
+# Write /predict logs synchronously (returns the row id as log_id) instead of queueing
+LOG_SYNC = os.getenv("DB_LOG_SYNC", "false").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+if not USE_PURE and not getattr(mysql_connector, "HAVE_CEXT", False):
+    logger.info("mysql-connector C extension not available; using the pure-Python protocol")
+
+# DB_SKIP_INIT=true: the schema is managed externally, never run init_db() implicitly
+_schema_ready = os.getenv("DB_SKIP_INIT", "false").lower() in ("1", "true", "yes")
 _schema_lock = threading.Lock()
 
+_scope = threading.local()  # .conns: readonly flag -> connection, while a scope is open
 
-def _connect(with_database: bool = True):
+_pools = {}  # readonly flag -> pool of the current process
+_pool_pid = None
+_pool_lock = threading.Lock()
+_overflow_slots = threading.BoundedSemaphore(POOL_OVERFLOW)  # reset per process with _pools
+
+# Short-lived per-process cache of users rows keyed by id/username/email,
+# without password hashes (logins always read the DB). Writes made through
+# this module invalidate it; role/permission changes made by other processes
+# become visible after at most DB_USER_CACHE_TTL seconds (0 = off).
+USER_CACHE_TTL = float(os.getenv("DB_USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = 3072
+_user_cache = {}  # (kind, key) -> (expires_at, user dict)
+_user_cache_lock = threading.Lock()
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_writer = None
+_log_writer_lock = threading.Lock()
+# Set while the log writer's most recent batch reached the DB
+_log_db_ok = threading.Event()
+
+
+def _connect_config(with_database: bool = True, readonly: bool = False) -> dict:
     cfg = {
         "host": MYSQL_CONFIG["host"],
         "port": MYSQL_CONFIG["port"],
         "user": MYSQL_CONFIG["user"],
         "password": MYSQL_CONFIG["password"],
-        "autocommit": False,
+        "autocommit": readonly,
     }
+    if USE_PURE:
+        # Only passed when forced: use_pure=False raises if the C extension is missing
+        cfg["use_pure"] = True
     if with_database:
         cfg["database"] = MYSQL_CONFIG["database"]
-    return mysql_connector.connect(**cfg)
+    return cfg
+
+
+def _connect(with_database: bool = True, readonly: bool = False):
+    return mysql_connector.connect(**_connect_config(with_database, readonly))
+
+
+def _get_pool(readonly: bool = False):
+    """Per-process connection pool, created on first use.
+
+    Keyed by pid so a pool created before a fork (gunicorn preload) is never
+    shared with the worker processes. Sessions are reset when a connection is
+    returned so no open transaction/snapshot leaks to the next borrower.
+    Read-only callers get a separate autocommit pool, so a lone SELECT does
+    not open a transaction that is only discarded on close.
+    """
+    global _pool_pid, _overflow_slots
+    pid = os.getpid()
+    if _pool_pid == pid:
+        pool = _pools.get(readonly)
+        if pool is not None:
+            return pool
+    with _pool_lock:
+        if _pool_pid != pid:
+            _pools.clear()
+            _overflow_slots = threading.BoundedSemaphore(POOL_OVERFLOW)
+            _pool_pid = pid
+        pool = _pools.get(readonly)
+        if pool is None:
+            pool = mysql_pooling.MySQLConnectionPool(
+                pool_name=f"phishguard-{pid}-{'ro' if readonly else 'rw'}",
+                pool_size=RO_POOL_SIZE if readonly else POOL_SIZE,
+                pool_reset_session=True,
+                **_connect_config(with_database=True, readonly=readonly),
+            )
+            _pools[readonly] = pool
+    return pool
 
 
 def _ensure_database_exists():
@@ -92,21 +287,119 @@ def _ensure_database_exists():
             pass
         conn.close()
 
-def get_connection():
+def get_connection(readonly: bool = False):
+    """Pooled connection; the schema is created/migrated once per process first.
+
+    readonly=True returns an autocommit connection for single-SELECT reads.
+    Inside a connection scope (one per Flask request) every call on the thread
+    shares one connection per mode, returned to the pool when the scope ends.
+    """
+    if not _schema_ready:
+        init_db()
+    conns = getattr(_scope, "conns", None)
+    if conns is None:
+        return _checkout(readonly)
+    conn = conns.get(readonly)
+    if conn is None:
+        conn = conns[readonly] = _ScopedConnection(_checkout(readonly))
+    return conn
+
+
+class _ScopedConnection:
+    """Connection shared by the db calls of one scope; close() waits for end_connection_scope()."""
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        # The next call reuses this session: never let it inherit (and later
+        # commit) a transaction a failed call left open
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _OverflowConnection:
+    """Direct connection opened past the pool; close() also frees its overflow slot."""
+
+    __slots__ = ("_conn", "_slots")
+
+    def __init__(self, conn, slots):
+        self._conn = conn
+        self._slots = slots
+
+    def close(self):
+        slots, self._slots = self._slots, None
+        try:
+            self._conn.close()
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _borrow(readonly: bool = False):
+    """Pooled connection, else a bounded overflow connection, waiting up to DB_POOL_TIMEOUT."""
+    pool = _get_pool(readonly)
+    deadline = time.monotonic() + POOL_TIMEOUT_SECONDS
+    while True:
+        try:
+            return pool.get_connection()
+        except mysql_connector.PoolError:
+            pass
+        slots = _overflow_slots
+        if slots.acquire(blocking=False):
+            try:
+                return _OverflowConnection(_connect(readonly=readonly), slots)
+            except BaseException:
+                slots.release()
+                raise
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"No database connection free within {POOL_TIMEOUT_SECONDS:g}s (pool and overflow busy)")
+        time.sleep(0.01)
+
+
+def begin_connection_scope():
+    """Share connections between the db calls made on this thread until end_connection_scope()."""
+    _scope.conns = {}
+
+
+def end_connection_scope():
+    """Return the scope's connections (if any were used) to the pool."""
+    conns = getattr(_scope, "conns", None)
+    _scope.conns = None
+    for conn in (conns or {}).values():
+        try:
+            conn._conn.close()
+        except Exception as exc:
+            logger.warning("Releasing scoped DB connection failed: %s", exc)
+
+
+def _checkout(readonly: bool = False):
     last_exc = None
     for attempt in range(1, RETRY_ATTEMPTS + 1):
         try:
             try:
-                return _connect(with_database=True)
+                return _borrow(readonly)
             except mysql_connector.Error as exc:
                 # 1049 = ER_BAD_DB_ERROR (unknown database)
                 if getattr(exc, "errno", None) == 1049:
                     _ensure_database_exists()
-                    return _connect(with_database=True)
+                    return _borrow(readonly)
                 raise
         except mysql_connector.Error as exc:
             last_exc = exc
-            time.sleep(RETRY_DELAY_SECONDS)
+            if attempt < RETRY_ATTEMPTS:
+                # Capped exponential backoff with jitter, so workers don't all
+                # reconnect in lockstep while the server is restarting
+                delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.75, 1.25))
     raise RuntimeError(f"Database connection failed after {RETRY_ATTEMPTS} attempts") from last_exc
 
 def init_db():
@@ -116,9 +409,12 @@ def init_db():
     with _schema_lock:
         if _schema_ready:
             return
-        conn = get_connection()
+        conn = _checkout()
         try:
             cur = conn.cursor()
+            if _stored_schema_version(cur) == SCHEMA_VERSION:
+                _schema_ready = True
+                return
             cur.execute(
                 f"""
                 CREATE TABLE IF NOT EXISTS {PREDICTIONS_TABLE} (
@@ -127,55 +423,58 @@ def init_db():
                     owner_username VARCHAR(128),
                     url TEXT,
                     masked_url TEXT,
-                    features_json LONGTEXT,
+                    features_json JSON,
                     prediction TINYINT,
                     probability DOUBLE,
                     device VARCHAR(255),
                     ip VARCHAR(64),
-                    metadata_json LONGTEXT,
+                    metadata_json JSON,
                     model_version VARCHAR(128),
                     timestamp BIGINT
                 ) ENGINE=InnoDB
                 """
             )
 
+            # One SHOW COLUMNS per table instead of an INFORMATION_SCHEMA probe per column
+            prediction_cols = _table_columns(cur, PREDICTIONS_TABLE)
+
             # Migrate predictions: add owner_user_id if needed
-            cur.execute(
-                """
-                SELECT COUNT(*)
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME='owner_user_id'
-                """,
-                (MYSQL_CONFIG["database"], PREDICTIONS_TABLE),
-            )
-            has_owner_user_id = int(cur.fetchone()[0]) > 0
-            if not has_owner_user_id:
+            if "owner_user_id" not in prediction_cols:
                 cur.execute(f"ALTER TABLE {PREDICTIONS_TABLE} ADD COLUMN owner_user_id INT")
 
             # Migrate existing tables to include owner_username if needed
-            cur.execute(
-                """
-                SELECT COUNT(*)
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME='owner_username'
-                """,
-                (MYSQL_CONFIG["database"], PREDICTIONS_TABLE),
-            )
-            has_owner = int(cur.fetchone()[0]) > 0
-            if not has_owner:
+            if "owner_username" not in prediction_cols:
                 cur.execute(f"ALTER TABLE {PREDICTIONS_TABLE} ADD COLUMN owner_username VARCHAR(128)")
 
-            # Helpful indexes
-            try:
-                cur.execute(f"CREATE INDEX idx_owner_ts ON {PREDICTIONS_TABLE} (owner_username, timestamp)")
-            except mysql_connector.Error:
-                # index may already exist
-                pass
-
-            try:
-                cur.execute(f"CREATE INDEX idx_owner_user_ts ON {PREDICTIONS_TABLE} (owner_user_id, timestamp)")
-            except mysql_connector.Error:
-                pass
+            # Migrate LONGTEXT JSON columns to the native JSON type (binary storage,
+            # validated on write). Older rows may hold text MySQL rejects as JSON
+            # (e.g. NaN); the columns then stay LONGTEXT, which still works.
+            if any(prediction_cols.get(col, "json") != "json" for col in ("features_json", "metadata_json")):
+                try:
+                    cur.execute(
+                        f"ALTER TABLE {PREDICTIONS_TABLE} MODIFY features_json JSON, MODIFY metadata_json JSON"
+                    )
+                except mysql_connector.Error as exc:
+                    logger.warning("Keeping LONGTEXT JSON columns in %s: %s", PREDICTIONS_TABLE, exc)
+
+            # Helpful indexes. MySQL has no CREATE INDEX IF NOT EXISTS, so create
+            # only those missing; a failure is then a real problem worth logging.
+            # idx_owner_user_id / idx_owner_id let per-owner feeds
+            # (WHERE owner_... ORDER BY id DESC LIMIT n) walk the index backwards
+            # and stop after n entries instead of sorting every match.
+            existing_indexes = _table_indexes(cur, PREDICTIONS_TABLE)
+            for index_name, index_cols in (
+                ("idx_owner_ts", "owner_username, timestamp"),
+                ("idx_owner_user_ts", "owner_user_id, timestamp"),
+                ("idx_owner_user_id", "owner_user_id, id"),
+                ("idx_owner_id", "owner_username, id"),
+            ):
+                if index_name in existing_indexes:
+                    continue
+                try:
+                    cur.execute(f"CREATE INDEX {index_name} ON {PREDICTIONS_TABLE} ({index_cols})")
+                except mysql_connector.Error as exc:
+                    logger.warning("Could not create index %s on %s: %s", index_name, PREDICTIONS_TABLE, exc)
 
             # Permissions table
             cur.execute(
@@ -207,17 +506,12 @@ def init_db():
             )
 
             # Migrate users table columns for older installs
+            user_cols = _table_columns(cur, USERS_TABLE)
+
             def _ensure_user_col(col_name: str, ddl: str):
-                cur.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME=%s
-                    """,
-                    (MYSQL_CONFIG["database"], USERS_TABLE, col_name),
-                )
-                if int(cur.fetchone()[0]) == 0:
+                if col_name not in user_cols:
                     cur.execute(f"ALTER TABLE {USERS_TABLE} ADD COLUMN {ddl}")
+                    user_cols[col_name] = ddl.split()[1].lower()
 
             _ensure_user_col("email", "email VARCHAR(255) UNIQUE")
             _ensure_user_col("last_login_ip", "last_login_ip VARCHAR(64)")
@@ -234,30 +528,26 @@ def init_db():
             except Exception:
                 pass
 
-            def _has_user_col(col_name: str) -> bool:
-                cur.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s AND COLUMN_NAME=%s
-                    """,
-                    (MYSQL_CONFIG["database"], USERS_TABLE, col_name),
-                )
-                return int(cur.fetchone()[0]) > 0
-
             # Copy legacy last_ip/last_device if present
             try:
-                if _has_user_col("last_ip"):
+                if "last_ip" in user_cols:
                     cur.execute(
                         f"UPDATE {USERS_TABLE} SET last_login_ip=last_ip WHERE (last_login_ip IS NULL OR last_login_ip='') AND last_ip IS NOT NULL AND last_ip<>''"
                     )
-                if _has_user_col("last_device"):
+                if "last_device" in user_cols:
                     cur.execute(
                         f"UPDATE {USERS_TABLE} SET last_login_device=last_device WHERE (last_login_device IS NULL OR last_login_device='') AND last_device IS NOT NULL AND last_device<>''"
                     )
             except Exception:
                 pass
 
+            # Backfill owner_user_id on rows logged before it existed, so per-user
+            # queries need only the owner_user_id predicate
+            cur.execute(
+                f"UPDATE {PREDICTIONS_TABLE} p JOIN {USERS_TABLE} u ON p.owner_username IN (u.username, u.email) "
+                "SET p.owner_user_id = u.id WHERE p.owner_user_id IS NULL"
+            )
+
             # Bootstrap: create initial admin/user if users table is empty
             cur.execute(f"SELECT COUNT(*) FROM {USERS_TABLE}")
             user_count = int(cur.fetchone()[0] or 0)
@@ -268,61 +558,102 @@ def init_db():
                     return u if "@" in u else f"{u}@local"
 
                 cur.execute(
-                    f"INSERT INTO {USERS_TABLE} (email, username, password_hash, role, can_delete_own_logs, created_at, last_login_at) VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                    _INSERT_USER_SQL,
                     (_default_email(ADMIN_USERNAME), ADMIN_USERNAME, _hash_password(ADMIN_PASSWORD), "admin", 1, now, now),
                 )
                 cur.execute(
-                    f"INSERT INTO {USERS_TABLE} (email, username, password_hash, role, can_delete_own_logs, created_at, last_login_at) VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                    _INSERT_USER_SQL,
                     (_default_email(USER_USERNAME), USER_USERNAME, _hash_password(USER_PASSWORD), "user", 0, now, now),
                 )
+
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {SCHEMA_META_TABLE} (
+                    id TINYINT PRIMARY KEY,
+                    version INT NOT NULL
+                ) ENGINE=InnoDB
+                """
+            )
+            cur.execute(
+                f"INSERT INTO {SCHEMA_META_TABLE} (id, version) VALUES (1, %s) ON DUPLICATE KEY UPDATE version=VALUES(version)",
+                (SCHEMA_VERSION,),
+            )
             conn.commit()
             _schema_ready = True
         finally:
             cur.close()
             conn.close()
 
+
+def _table_columns(cur, table: str) -> dict:
+    """Column name -> lower-case base type (e.g. "json", "varchar") of a table."""
+    cur.execute(f"SHOW COLUMNS FROM {table}")
+    cols = {}
+    for row in cur.fetchall():
+        name, col_type = row[0], row[1]
+        if isinstance(col_type, (bytes, bytearray)):
+            col_type = col_type.decode("utf-8")
+        cols[name] = col_type.split("(")[0].lower()
+    return cols
+
+
+def _table_indexes(cur, table: str) -> set:
+    cur.execute(f"SHOW INDEX FROM {table}")
+    # Key_name is the third column
+    return {row[2] for row in cur.fetchall()}
+
+
+def _stored_schema_version(cur) -> int | None:
+    """Schema version recorded by a previous init_db(), None if never stamped."""
+    try:
+        cur.execute(f"SELECT version FROM {SCHEMA_META_TABLE} WHERE id=1")
+        row = cur.fetchone()
+    except mysql_connector.Error:
+        # Fresh database or an install from before schema versioning
+        return None
+    return int(row[0]) if row else None
+
 def mask_url(url: str) -> str:
     if LOG_FULL_URLS:
         return url
     if not url:
         return ""
-    try:
-        from urllib.parse import urlparse
-        parsed = urlparse(url)
-        scheme = parsed.scheme + "://" if parsed.scheme else ""
-        host = parsed.netloc if parsed.netloc else parsed.path
-        return f"{scheme}{host[:40]}... (masked)"
-    except Exception:
-        return url[:40] + "... (masked)" if len(url) > 50 else url
+    scheme, sep, rest = url.partition("://")
+    if sep:
+        # host ends at the first path delimiter, as urlparse's netloc does
+        scheme = scheme.lower() + sep
+        rest = rest.partition("/")[0]
+    else:
+        # no scheme: urlparse puts everything before ?/# into path
+        scheme, rest = "", url
+    host = rest.partition("?")[0].partition("#")[0]
+    return f"{scheme}{host[:40]}... (masked)"
+
+def _prediction_row(url, features: dict, prediction: int, probability: float, device: str, ip: str, metadata: dict, model_version: str, owner_username: str = "anonymous", owner_user_id: int | None = None) -> tuple:
+    masked = mask_url(url)
+    return (
+        int(owner_user_id) if owner_user_id is not None else None,
+        owner_username,
+        # the url column only holds full URLs; masked ones live in masked_url alone
+        url if LOG_FULL_URLS else None,
+        masked,
+        _dumps(features),
+        int(prediction),
+        float(probability or 0.0),
+        device,
+        ip,
+        _dumps(metadata or {}),
+        model_version,
+        time.time_ns() // 1_000_000_000,
+    )
+
 
 def insert_prediction(url, features: dict, prediction: int, probability: float, device: str, ip: str, metadata: dict, model_version: str, owner_username: str = "anonymous", owner_user_id: int | None = None):
-    init_db()
     conn = get_connection()
     cur = conn.cursor()
-    timestamp = int(time.time())
-    features_json = json.dumps(features)
-    metadata_json = json.dumps(metadata or {})
-    masked = mask_url(url)
     cur.execute(
-        f"""
-        INSERT INTO {PREDICTIONS_TABLE}
-            (owner_user_id, owner_username, url, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (
-            int(owner_user_id) if owner_user_id is not None else None,
-            owner_username,
-            url if LOG_FULL_URLS else masked,
-            masked,
-            features_json,
-            int(prediction),
-            float(probability or 0.0),
-            device,
-            ip,
-            metadata_json,
-            model_version,
-            timestamp,
-        ),
+        _INSERT_PREDICTION_SQL,
+        _prediction_row(url, features, prediction, probability, device, ip, metadata, model_version, owner_username, owner_user_id),
     )
     conn.commit()
     row_id = cur.lastrowid
@@ -330,41 +661,254 @@ def insert_prediction(url, features: dict, prediction: int, probability: float,
     conn.close()
     return row_id
 
-def get_recent(limit=50):
-    init_db()
-    conn = get_connection()
+
+def _insert_rows(conn, rows: list):
     cur = conn.cursor()
-    cur.execute(
-        f"""
-        SELECT id, owner_user_id, owner_username, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp
-        FROM {PREDICTIONS_TABLE}
-        ORDER BY id DESC
-        LIMIT %s
-        """,
-        (limit,),
-    )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    results = []
-    for row in rows:
-        results.append(
-            {
-                "id": int(row[0]),
-                "owner_user_id": int(row[1]) if row[1] is not None else None,
-                "owner_username": row[2] or "anonymous",
-                "url": row[3],
-                "features": json.loads(row[4] or "{}"),
-                "prediction": int(row[5]) if row[5] is not None else -1,
-                "probability": float(row[6]) if row[6] is not None else 0.0,
-                "device": row[7],
-                "ip": row[8],
-                "metadata": json.loads(row[9] or "{}"),
-                "model_version": row[10],
-                "timestamp": int(row[11]) if row[11] is not None else 0,
-            }
-        )
-    return results
+    try:
+        cur.executemany(_INSERT_PREDICTION_SQL, rows)
+        conn.commit()
+    finally:
+        cur.close()
+
+
+def insert_predictions(rows: list) -> int:
+    """Insert many rows built by _prediction_row in one multi-row INSERT + commit."""
+    if not rows:
+        return 0
+    conn = get_connection()
+    try:
+        _insert_rows(conn, rows)
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def _drain_log_queue():
+    # The writer thread keeps one dedicated connection instead of borrowing
+    # from the pool per batch (which costs a session reset round trip each time)
+    conn = None
+    while True:
+        batch = [_log_queue.get()]
+        deadline = time.monotonic() + LOG_LINGER_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(_log_queue.get(timeout=remaining))
+                else:
+                    batch.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        conn = _write_log_batch(batch, conn)
+
+
+def _ensure_log_writer():
+    """Start the log writer lazily (and again in forked worker processes)."""
+    global _log_writer
+    if _log_writer is not None and _log_writer.is_alive():
+        return
+    with _log_writer_lock:
+        if _log_writer is None or not _log_writer.is_alive():
+            _log_writer = threading.Thread(target=_drain_log_queue, name="prediction-log-writer", daemon=True)
+            _log_writer.start()
+
+
+def flush_prediction_log():
+    """Write out rows still waiting in the log queue (runs at interpreter exit)."""
+    conn = None
+    batch = []
+    while True:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+        if len(batch) >= LOG_BATCH_SIZE:
+            conn = _write_log_batch(batch, conn)
+            batch = []
+    conn = _write_log_batch(batch, conn)
+    _close_quietly(conn)
+
+
+def _close_quietly(conn):
+    if conn is None:
+        return
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _writer_connection():
+    if not _schema_ready:
+        init_db()
+    return _connect()
+
+
+def _write_log_batch(batch: list, conn=None):
+    """Insert a batch of log rows on conn (opened if None); drop it on failure.
+
+    Returns the connection to reuse for the next batch, or None after an error.
+    A reused connection may have been closed by the server while idle
+    (wait_timeout), so one failure on it is retried on a fresh connection.
+    """
+    if not batch:
+        return conn
+    if conn is not None:
+        try:
+            _insert_rows(conn, batch)
+            _log_db_ok.set()
+            return conn
+        except Exception:
+            _close_quietly(conn)
+            conn = None
+    try:
+        conn = _writer_connection()
+        _insert_rows(conn, batch)
+        _log_db_ok.set()
+        return conn
+    except Exception as exc:
+        _log_db_ok.clear()
+        logger.warning("Dropping %d prediction log rows: %s", len(batch), exc)
+        _close_quietly(conn)
+        return None
+
+
+atexit.register(flush_prediction_log)
+
+
+def enqueue_prediction(url, features: dict, prediction: int, probability: float, device: str, ip: str, metadata: dict, model_version: str, owner_username: str = "anonymous", owner_user_id: int | None = None) -> bool:
+    """Queue a prediction log row for the background writer.
+
+    When the queue is full but the writer's last batch succeeded, the DB is up
+    and merely slower than the traffic: the row is written inline instead, which
+    also slows callers down to what the DB sustains. Returns False (row dropped)
+    when the queue is full while the DB is failing, so requests never wait on
+    connect retries.
+    """
+    _ensure_log_writer()
+    row = _prediction_row(url, features, prediction, probability, device, ip, metadata, model_version, owner_username, owner_user_id)
+    try:
+        _log_queue.put_nowait(row)
+        return True
+    except queue.Full:
+        pass
+    if not _log_db_ok.is_set():
+        return False
+    try:
+        insert_predictions([row])
+        return True
+    except Exception as exc:
+        logger.warning("Inline prediction log write failed: %s", exc)
+        return False
+
+def _prediction_fields(row: dict) -> dict:
+    """API fields of one predictions row except the two JSON columns.
+
+    The driver already returns int/float for the numeric columns; only NULLs
+    need defaults.
+    """
+    return {
+        "id": row["id"],
+        "owner_user_id": row["owner_user_id"],
+        "owner_username": row["owner_username"] or "anonymous",
+        "url": row["masked_url"],
+        "prediction": row["prediction"] if row["prediction"] is not None else -1,
+        "probability": row["probability"] if row["probability"] is not None else 0.0,
+        "device": row["device"],
+        "ip": row["ip"],
+        "model_version": row["model_version"],
+        "timestamp": row["timestamp"] if row["timestamp"] is not None else 0,
+    }
+
+
+def _prediction_dict(row: dict) -> dict:
+    """API shape of one predictions row read with a dictionary cursor."""
+    out = _prediction_fields(row)
+    out["features"] = _loads(row["features_json"])
+    out["metadata"] = _loads(row["metadata_json"])
+    return out
+
+
+def _dumpb(obj) -> bytes:
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode("utf-8")
+
+
+def _json_column_bytes(value) -> bytes:
+    if not value:
+        return b"{}"
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+
+
+def _prediction_json(row: dict) -> bytes:
+    """_prediction_dict(row) as JSON, with the JSON columns copied verbatim.
+
+    Only valid for native JSON columns: the server's JSON text is always valid,
+    while legacy LONGTEXT values may hold e.g. NaN.
+    """
+    head = _dumpb(_prediction_fields(row))
+    return b"".join((
+        head[:-1],
+        b',"features":', _json_column_bytes(row["features_json"]),
+        b',"metadata":', _json_column_bytes(row["metadata_json"]),
+        b"}",
+    ))
+
+
+def _prediction_json_decoded(row: dict) -> bytes:
+    return _dumpb(_prediction_dict(row))
+
+
+LOG_FETCH_CHUNK = 256
+
+
+def _iter_predictions(sql: str, params: tuple, as_json: bool = False):
+    """Yield API dicts (or JSON bytes) for a predictions SELECT, reading rows in chunks.
+
+    Only one chunk of raw driver rows is alive at a time (fetchall would keep
+    every raw row alongside the converted dicts).
+    """
+    conn = get_connection(readonly=True)
+    cur = conn.cursor(dictionary=True)
+    try:
+        cur.execute(sql, params)
+        convert = _prediction_dict
+        if as_json:
+            # Splice the stored JSON text directly unless a column is still LONGTEXT
+            json_types = {d[0]: d[1] for d in cur.description}
+            native = all(
+                json_types.get(col) == mysql_field_type.JSON for col in ("features_json", "metadata_json")
+            )
+            convert = _prediction_json if native else _prediction_json_decoded
+        while True:
+            rows = cur.fetchmany(LOG_FETCH_CHUNK)
+            if not rows:
+                break
+            for row in rows:
+                yield convert(row)
+    finally:
+        try:
+            # A consumer that stops early leaves rows unread on the connection
+            conn.consume_results()
+        finally:
+            cur.close()
+            conn.close()
+
+
+def _predictions_json(sql: str, params: tuple) -> bytes:
+    return b"[" + b",".join(_iter_predictions(sql, params, as_json=True)) + b"]"
+
+
+def iter_recent(limit=50):
+    return _iter_predictions(_RECENT_SQL, (limit,))
+
+
+def get_recent_json(limit=50) -> bytes:
+    """get_recent() serialized as a JSON array, without decoding the JSON columns."""
+    return _predictions_json(_RECENT_SQL, (limit,))
+
+
+def get_recent(limit=50):
+    return list(iter_recent(limit))
 
 
 def clear_logs() -> int:
@@ -372,11 +916,10 @@ def clear_logs() -> int:
 
     Returns the number of deleted rows when available (may be -1 depending on driver).
     """
-    init_db()
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute(f"DELETE FROM {PREDICTIONS_TABLE}")
+        cur.execute(_DELETE_ALL_LOGS_SQL)
         deleted = cur.rowcount
         conn.commit()
         return int(deleted) if deleted is not None else -1
@@ -386,11 +929,10 @@ def clear_logs() -> int:
 
 
 def delete_logs_for_user(username: str) -> int:
-    init_db()
     conn = get_connection()
     cur = conn.cursor()
     try:
-        cur.execute(f"DELETE FROM {PREDICTIONS_TABLE} WHERE owner_username=%s", (username,))
+        cur.execute(_DELETE_LOGS_FOR_USER_SQL, (username,))
         deleted = cur.rowcount
         conn.commit()
         return int(deleted) if deleted is not None else -1
@@ -411,7 +953,6 @@ def _resolve_user(identifier):
 
 
 def set_user_can_delete_own(user_id_or_login, can_delete: bool) -> None:
-    init_db()
     user = _resolve_user(user_id_or_login)
     if not user:
         raise ValueError("user not found")
@@ -420,26 +961,16 @@ def set_user_can_delete_own(user_id_or_login, can_delete: bool) -> None:
     cur = conn.cursor()
     try:
         # Mirror into users table (source of truth)
-        cur.execute(
-            f"UPDATE {USERS_TABLE} SET can_delete_own_logs=%s WHERE id=%s",
-            (1 if can_delete else 0, int(user.get("id"))),
-        )
-        cur.execute(
-            f"""
-            INSERT INTO {PERMISSIONS_TABLE} (username, can_delete_own_logs, updated_at)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY UPDATE can_delete_own_logs=VALUES(can_delete_own_logs), updated_at=VALUES(updated_at)
-            """,
-            (username, 1 if can_delete else 0, int(time.time())),
-        )
+        cur.execute(_SET_CAN_DELETE_SQL, (1 if can_delete else 0, int(user.get("id"))))
+        cur.execute(_UPSERT_PERMISSION_SQL, (username, 1 if can_delete else 0, int(time.time())))
         conn.commit()
+        _forget_user(user.get("id"))
     finally:
         cur.close()
         conn.close()
 
 
 def get_user_can_delete_own(user_id_or_login) -> bool:
-    init_db()
     user = _resolve_user(user_id_or_login)
     if user and "can_delete_own_logs" in user:
         return bool(user.get("can_delete_own_logs"))
@@ -448,13 +979,10 @@ def get_user_can_delete_own(user_id_or_login) -> bool:
         username = user.get("username") or user.get("email")
     else:
         username = str(user_id_or_login or "").strip()
-    conn = get_connection()
+    conn = get_connection(readonly=True)
     cur = conn.cursor()
     try:
-        cur.execute(
-            f"SELECT can_delete_own_logs FROM {PERMISSIONS_TABLE} WHERE username=%s",
-            (username,),
-        )
+        cur.execute(_SELECT_PERMISSION_SQL, (username,))
         row = cur.fetchone()
         return bool(int(row[0])) if row else False
     finally:
@@ -462,114 +990,117 @@ def get_user_can_delete_own(user_id_or_login) -> bool:
         conn.close()
 
 
-def get_user_by_id(user_id: int):
-    init_db()
-    conn = get_connection()
+def _cached_user(kind: str, key):
+    """Copy of a cached users row for (kind, key), or None when absent/expired."""
+    if USER_CACHE_TTL <= 0:
+        return None
+    with _user_cache_lock:
+        entry = _user_cache.get((kind, key))
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return dict(entry[1])
+
+
+def _cache_user(user: dict) -> dict:
+    """Remember a users row under its id, username and email; returns a copy.
+
+    The password hash is never cached (or returned): a password change made by
+    another worker must take effect at once, not after DB_USER_CACHE_TTL.
+    """
+    user = {k: v for k, v in user.items() if k != "password_hash"}
+    if USER_CACHE_TTL > 0:
+        expires = time.monotonic() + USER_CACHE_TTL
+        with _user_cache_lock:
+            for key in (("id", user["id"]), ("username", user["username"]), ("email", user["email"])):
+                if key[1] is None:
+                    continue
+                _user_cache.pop(key, None)
+                while len(_user_cache) >= USER_CACHE_SIZE:
+                    # evict the oldest insertion
+                    del _user_cache[next(iter(_user_cache))]
+                _user_cache[key] = (expires, user)
+    return dict(user)
+
+
+def _forget_user(user_id_or_login):
+    """Drop every cached key of the user(s) matching an id, username or email."""
+    s = str(user_id_or_login or "").strip()
+    with _user_cache_lock:
+        stale = [
+            key for key, (_, u) in _user_cache.items()
+            if str(u["id"]) == s or u["username"] == s or (u["email"] or "") == s.lower()
+        ]
+        for key in stale:
+            del _user_cache[key]
+
+
+def _user_from_row(row, cols: tuple = _USER_COLS) -> dict:
+    user = dict(zip(cols, row))
+    user["id"] = int(user["id"])
+    user["role"] = user["role"] or "user"
+    user["can_delete_own_logs"] = bool(int(user["can_delete_own_logs"] or 0))
+    user["created_at"] = int(user["created_at"] or 0)
+    user["last_login_at"] = int(user["last_login_at"] or 0)
+    return user
+
+
+def _fetch_user(column: str, value):
+    """users row straight from the DB, password_hash included (never cached)."""
+    conn = get_connection(readonly=True)
     cur = conn.cursor()
     try:
-        cur.execute(
-            f"SELECT id, email, username, password_hash, role, can_delete_own_logs, last_login_ip, last_login_device, created_at, last_login_at FROM {USERS_TABLE} WHERE id=%s",
-            (int(user_id),),
-        )
+        cur.execute(_SELECT_USER_SQL[column], (value,))
         row = cur.fetchone()
-        if not row:
-            return None
-        return {
-            "id": int(row[0]),
-            "email": row[1],
-            "username": row[2],
-            "password_hash": row[3],
-            "role": row[4] or "user",
-            "can_delete_own_logs": bool(int(row[5] or 0)),
-            "last_login_ip": row[6],
-            "last_login_device": row[7],
-            "created_at": int(row[8] or 0),
-            "last_login_at": int(row[9] or 0),
-        }
+        return _user_from_row(row) if row else None
     finally:
         cur.close()
         conn.close()
 
 
+def _lookup_user(column: str, value):
+    """Cached users row without password_hash, fetched on a miss."""
+    cached = _cached_user(column, value)
+    if cached is not None:
+        return cached
+    user = _fetch_user(column, value)
+    return _cache_user(user) if user else None
+
+
+def get_user_by_id(user_id: int):
+    return _lookup_user("id", int(user_id))
+
+
 def get_user(username: str):
-    init_db()
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            f"SELECT id, email, username, password_hash, role, can_delete_own_logs, last_login_ip, last_login_device, created_at, last_login_at FROM {USERS_TABLE} WHERE username=%s",
-            (username,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {
-            "id": int(row[0]),
-            "email": row[1],
-            "username": row[2],
-            "password_hash": row[3],
-            "role": row[4] or "user",
-            "can_delete_own_logs": bool(int(row[5] or 0)),
-            "last_login_ip": row[6],
-            "last_login_device": row[7],
-            "created_at": int(row[8] or 0),
-            "last_login_at": int(row[9] or 0),
-        }
-    finally:
-        cur.close()
-        conn.close()
+    return _lookup_user("username", username)
 
 
 def get_user_by_email(email: str):
-    init_db()
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            f"SELECT id, email, username, password_hash, role, can_delete_own_logs, last_login_ip, last_login_device, created_at, last_login_at FROM {USERS_TABLE} WHERE email=%s",
-            ((email or "").strip().lower(),),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {
-            "id": int(row[0]),
-            "email": row[1],
-            "username": row[2],
-            "password_hash": row[3],
-            "role": row[4] or "user",
-            "can_delete_own_logs": bool(int(row[5] or 0)),
-            "last_login_ip": row[6],
-            "last_login_device": row[7],
-            "created_at": int(row[8] or 0),
-            "last_login_at": int(row[9] or 0),
-        }
-    finally:
-        cur.close()
-        conn.close()
+    return _lookup_user("email", (email or "").strip().lower())
 
 
 def verify_user_password(login: str, password: str) -> dict | None:
+    """The user (without password_hash) when the password matches, else None."""
     login = (login or "").strip()
-    user = get_user_by_email(login.lower()) if "@" in login else get_user(login)
+    # Always read the hash from the DB, never from the per-process cache
+    user = _fetch_user("email", login.lower()) if "@" in login else _fetch_user("username", login)
     if not user:
         return None
     if not user.get("password_hash"):
         return None
     if _verify_password(user["password_hash"], password):
-        # If legacy hash, upgrade in-place to bcrypt
-        if not _is_bcrypt_hash(user["password_hash"]):
+        # Re-hash legacy (werkzeug) hashes, and bcrypt hashes made with a
+        # different BCRYPT_ROUNDS, in place: once per user per policy change
+        if _bcrypt_cost(user["password_hash"]) != BCRYPT_ROUNDS:
             try:
                 set_user_password(user.get("id"), password)
-                user = get_user_by_id(int(user.get("id"))) or user
             except Exception:
                 pass
-        return user
+        return _cache_user(user)
     return None
 
 
 def create_user(email: str, password: str, role: str = "user", username: str | None = None) -> None:
-    init_db()
+    password_hash = _hash_password(password)
     conn = get_connection()
     cur = conn.cursor()
     try:
@@ -577,8 +1108,8 @@ def create_user(email: str, password: str, role: str = "user", username: str | N
         email_norm = (email or "").strip().lower()
         username_val = (username or "").strip() or email_norm
         cur.execute(
-            f"INSERT INTO {USERS_TABLE} (email, username, password_hash, role, can_delete_own_logs, created_at, last_login_at) VALUES (%s,%s,%s,%s,%s,%s,%s)",
-            (email_norm, username_val, _hash_password(password), role, 0, now, now),
+            _INSERT_USER_SQL,
+            (email_norm, username_val, password_hash, role, 0, now, now),
         )
         conn.commit()
     finally:
@@ -587,205 +1118,85 @@ def create_user(email: str, password: str, role: str = "user", username: str | N
 
 
 def list_users():
-    init_db()
-    conn = get_connection()
+    conn = get_connection(readonly=True)
     cur = conn.cursor()
     try:
-        cur.execute(
-            f"SELECT id, email, username, role, can_delete_own_logs, last_login_ip, last_login_device, created_at, last_login_at FROM {USERS_TABLE} ORDER BY email ASC"
-        )
-        rows = cur.fetchall()
-        out = []
-        for r in rows:
-            out.append({
-                "id": int(r[0]),
-                "email": r[1],
-                "username": r[2],
-                "role": r[3] or "user",
-                "can_delete_own_logs": bool(int(r[4] or 0)),
-                "last_login_ip": r[5],
-                "last_login_device": r[6],
-                "created_at": int(r[7] or 0),
-                "last_login_at": int(r[8] or 0),
-            })
-        return out
+        cur.execute(_LIST_USERS_SQL)
+        return [_user_from_row(row, _LIST_USER_COLS) for row in cur.fetchall()]
     finally:
         cur.close()
         conn.close()
 
 
+def _user_key(user_id_or_username) -> tuple:
+    """("id", int) for numeric identifiers, else ("username", str)."""
+    if isinstance(user_id_or_username, int) or str(user_id_or_username).isdigit():
+        return "id", int(user_id_or_username)
+    return "username", str(user_id_or_username)
+
+
 def set_user_role(user_id_or_username, role: str) -> None:
-    init_db()
+    col, key = _user_key(user_id_or_username)
     conn = get_connection()
     cur = conn.cursor()
     try:
-        if isinstance(user_id_or_username, int) or str(user_id_or_username).isdigit():
-            cur.execute(f"UPDATE {USERS_TABLE} SET role=%s WHERE id=%s", (role, int(user_id_or_username)))
-        else:
-            cur.execute(f"UPDATE {USERS_TABLE} SET role=%s WHERE username=%s", (role, str(user_id_or_username)))
+        cur.execute(_SET_ROLE_SQL[col], (role, key))
         conn.commit()
+        _forget_user(user_id_or_username)
     finally:
         cur.close()
         conn.close()
 
 
 def set_user_password(user_id_or_username, password: str) -> None:
-    init_db()
+    col, key = _user_key(user_id_or_username)
+    # Hash before borrowing a connection: bcrypt takes far longer than the UPDATE
+    new_hash = _hash_password(password)
     conn = get_connection()
     cur = conn.cursor()
     try:
-        new_hash = _hash_password(password)
-        if isinstance(user_id_or_username, int) or str(user_id_or_username).isdigit():
-            cur.execute(
-                f"UPDATE {USERS_TABLE} SET password_hash=%s WHERE id=%s",
-                (new_hash, int(user_id_or_username)),
-            )
-        else:
-            cur.execute(
-                f"UPDATE {USERS_TABLE} SET password_hash=%s WHERE username=%s",
-                (new_hash, str(user_id_or_username)),
-            )
+        cur.execute(_SET_PASSWORD_SQL[col], (new_hash, key))
         conn.commit()
+        _forget_user(user_id_or_username)
     finally:
         cur.close()
         conn.close()
 
 
 def record_user_login(user_id_or_username, ip: str, device: str) -> None:
-    init_db()
+    col, key = _user_key(user_id_or_username)
     conn = get_connection()
     cur = conn.cursor()
     try:
-        if isinstance(user_id_or_username, int) or str(user_id_or_username).isdigit():
-            cur.execute(
-                f"UPDATE {USERS_TABLE} SET last_login_ip=%s, last_login_device=%s, last_login_at=%s WHERE id=%s",
-                (ip, device, int(time.time()), int(user_id_or_username)),
-            )
-        else:
-            cur.execute(
-                f"UPDATE {USERS_TABLE} SET last_login_ip=%s, last_login_device=%s, last_login_at=%s WHERE username=%s",
-                (ip, device, int(time.time()), str(user_id_or_username)),
-            )
+        cur.execute(_RECORD_LOGIN_SQL[col], (ip, device, int(time.time()), key))
         conn.commit()
+        _forget_user(user_id_or_username)
     finally:
         cur.close()
         conn.close()
 
 
 def get_recent_for_user(username: str, limit: int = 50):
-    init_db()
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        f"""
-        SELECT id, owner_user_id, owner_username, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp
-        FROM {PREDICTIONS_TABLE}
-        WHERE owner_username=%s
-        ORDER BY id DESC
-        LIMIT %s
-        """,
-        (username, int(limit)),
-    )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    results = []
-    for row in rows:
-        results.append(
-            {
-                "id": int(row[0]),
-                "owner_user_id": int(row[1]) if row[1] is not None else None,
-                "owner_username": row[2] or "anonymous",
-                "url": row[3],
-                "features": json.loads(row[4] or "{}"),
-                "prediction": int(row[5]) if row[5] is not None else -1,
-                "probability": float(row[6]) if row[6] is not None else 0.0,
-                "device": row[7],
-                "ip": row[8],
-                "metadata": json.loads(row[9] or "{}"),
-                "model_version": row[10],
-                "timestamp": int(row[11]) if row[11] is not None else 0,
-            }
-        )
-    return results
+    return list(_iter_predictions(_RECENT_FOR_USER_SQL, (username, int(limit))))
+
+
+def get_recent_for_user_json(username: str, limit: int = 50) -> bytes:
+    return _predictions_json(_RECENT_FOR_USER_SQL, (username, int(limit)))
 
 
 def get_recent_for_user_id(user_id: int, limit: int = 50):
-    init_db()
-    user = get_user_by_id(int(user_id))
-    legacy_usernames = []
-    if user:
-        if user.get("email"):
-            legacy_usernames.append(str(user.get("email")))
-        if user.get("username") and str(user.get("username")) not in legacy_usernames:
-            legacy_usernames.append(str(user.get("username")))
-    conn = get_connection()
-    cur = conn.cursor()
-    if legacy_usernames:
-        cur.execute(
-            f"""
-            SELECT id, owner_user_id, owner_username, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp
-            FROM {PREDICTIONS_TABLE}
-            WHERE owner_user_id=%s OR owner_username IN (%s, %s)
-            ORDER BY id DESC
-            LIMIT %s
-            """,
-            (int(user_id), legacy_usernames[0], legacy_usernames[-1], int(limit)),
-        )
-    else:
-        cur.execute(
-            f"""
-            SELECT id, owner_user_id, owner_username, masked_url, features_json, prediction, probability, device, ip, metadata_json, model_version, timestamp
-            FROM {PREDICTIONS_TABLE}
-            WHERE owner_user_id=%s
-            ORDER BY id DESC
-            LIMIT %s
-            """,
-            (int(user_id), int(limit)),
-        )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    results = []
-    for row in rows:
-        results.append(
-            {
-                "id": int(row[0]),
-                "owner_user_id": int(row[1]) if row[1] is not None else None,
-                "owner_username": row[2] or "anonymous",
-                "url": row[3],
-                "features": json.loads(row[4] or "{}"),
-                "prediction": int(row[5]) if row[5] is not None else -1,
-                "probability": float(row[6]) if row[6] is not None else 0.0,
-                "device": row[7],
-                "ip": row[8],
-                "metadata": json.loads(row[9] or "{}"),
-                "model_version": row[10],
-                "timestamp": int(row[11]) if row[11] is not None else 0,
-            }
-        )
-    return results
+    return list(_iter_predictions(_RECENT_FOR_USER_ID_SQL, (int(user_id), int(limit))))
+
+
+def get_recent_for_user_id_json(user_id: int, limit: int = 50) -> bytes:
+    return _predictions_json(_RECENT_FOR_USER_ID_SQL, (int(user_id), int(limit)))
 
 
 def delete_logs_for_user_id(user_id: int) -> int:
-    init_db()
-    user = get_user_by_id(int(user_id))
-    legacy_usernames = []
-    if user:
-        if user.get("email"):
-            legacy_usernames.append(str(user.get("email")))
-        if user.get("username") and str(user.get("username")) not in legacy_usernames:
-            legacy_usernames.append(str(user.get("username")))
     conn = get_connection()
     cur = conn.cursor()
     try:
-        if legacy_usernames:
-            cur.execute(
-                f"DELETE FROM {PREDICTIONS_TABLE} WHERE owner_user_id=%s OR owner_username IN (%s, %s)",
-                (int(user_id), legacy_usernames[0], legacy_usernames[-1]),
-            )
-        else:
-            cur.execute(f"DELETE FROM {PREDICTIONS_TABLE} WHERE owner_user_id=%s", (int(user_id),))
+        cur.execute(_DELETE_LOGS_FOR_USER_ID_SQL, (int(user_id),))
         deleted = cur.rowcount
         conn.commit()
         return int(deleted) if deleted is not None else -1
@@ -1,14 +1,16 @@
-import re
+import ipaddress
 import math
 from collections import Counter
 import tldextract
 import string
-from typing import Dict
+from typing import Dict, List
 from urllib.parse import urlparse
 from config import SUSPICIOUS_TOKENS
 
-IP_REGEX = re.compile(r"^(?:\d{1,3}\.){3}\d{1,3}$")
 SPECIAL_CHARS = set(string.punctuation)
+# Public suffix list from the snapshot bundled with tldextract: no network
+# fetch or on-disk cache on first use, and the same result on every machine
+_TLD = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
 
 def shannon_entropy(s: str) -> float:
     if not s:
@@ -21,60 +23,113 @@ def shannon_entropy(s: str) -> float:
         entropy -= p * math.log2(p)
     return entropy
 
+def _url_stats(url: str):
+    """Single pass over the URL -> (count_digits, count_dots, count_hyphens,
+    count_underscores, num_special, entropy).
+
+    Builds one character histogram (Counter runs in C) and derives every
+    per-character statistic from it instead of rescanning the string.
+    """
+    counts = Counter(url)
+    length = len(url)
+    count_digits = 0
+    num_special = 0
+    entropy = 0.0
+    for ch, n in counts.items():
+        if ch.isdigit():
+            count_digits += n
+        elif ch in SPECIAL_CHARS:
+            num_special += n
+        p = n / length
+        entropy -= p * math.log2(p)
+    return count_digits, counts["."], counts["-"], counts["_"], num_special, entropy
+
 def has_ip_in_host(host: str) -> bool:
     if not host:
         return False
     host = host.strip("[]")
-    if IP_REGEX.match(host):
-        return True
-    if ":" in host and any(c.isalpha() or c.isdigit() for c in host):
+    parts = host.split(".")
+    if len(parts) == 4 and all(p.isascii() and p.isdigit() and len(p) <= 3 for p in parts):
+        return all(int(p) <= 255 for p in parts)
+    if ":" in host:
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            return False
         return True
     return False
 
+# SUSPICIOUS_TOKENS lowercased once, empty entries dropped
+_SUSPICIOUS_TOKENS_LOWER = tuple(t.lower() for t in SUSPICIOUS_TOKENS if t)
+
 def count_tokens_in_string(s: str, tokens=None) -> int:
     if not s:
         return 0
     if tokens is None:
-        tokens = SUSPICIOUS_TOKENS
+        tokens = _SUSPICIOUS_TOKENS_LOWER
+    else:
+        tokens = [t.lower() for t in tokens if t]
     s_low = s.lower()
     count = 0
     for t in tokens:
-        if not t:
-            continue
-        count += s_low.count(t.lower())
+        count += s_low.count(t)
     return count
 
+# Characters that make urlparse do more than split: ";" starts path params,
+# brackets are validated IPv6 hosts, and tab/CR/LF are stripped
+_SLOW_PARSE_CHARS = frozenset(";[]\t\r\n")
+
+def _split_url(url: str):
+    """(scheme, netloc, path, query, fragment) as urlparse returns them.
+
+    Plain ASCII http(s) URLs, the bulk of real traffic, are split with a few
+    str.find calls; anything else goes through urlparse.
+    """
+    if url.startswith(("http://", "https://")) and url.isascii() and _SLOW_PARSE_CHARS.isdisjoint(url):
+        start = url.find("://") + 3
+        frag = url.find("#", start)
+        end = frag if frag >= 0 else len(url)
+        qmark = url.find("?", start, end)
+        path_end = qmark if qmark >= 0 else end
+        slash = url.find("/", start, path_end)
+        host_end = slash if slash >= 0 else path_end
+        return (
+            url[:start - 3],
+            url[start:host_end],
+            url[host_end:path_end],
+            url[qmark + 1:end] if qmark >= 0 else "",
+            url[frag + 1:] if frag >= 0 else "",
+        )
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc, parsed.path, parsed.query, parsed.fragment
+
 def extract_features(url: str) -> Dict[str, float]:
     url = (url or "").strip()
     features = {}
-    parsed = urlparse(url if url else "")
-    scheme = parsed.scheme or ""
-    netloc = parsed.netloc or parsed.path
-    path = parsed.path or ""
-    query = parsed.query or ""
-    fragment = parsed.fragment or ""
-    te = tldextract.extract(url)
+    scheme, authority, path, query, fragment = _split_url(url)
+    netloc = authority or path
+    host = netloc
+    if host.startswith("["):
+        # IPv6 literal: keep the bracketed address, drop any port after it
+        host = host[:host.find("]") + 1] or host
+    elif ":" in host:
+        host = host.split(":")[0]
+    # tldextract only needs the authority part when the URL has one
+    # (it still strips userinfo and port itself); otherwise give it the URL
+    te = _TLD(authority or url)
     subdomain = te.subdomain or ""
     domain = te.domain or ""
     suffix = te.suffix or ""
-    host = netloc
-    if ":" in host:
-        host = host.split(":")[0]
     url_length = len(url)
     hostname_length = len(host)
-    count_dots = url.count(".")
-    count_hyphens = url.count("-")
-    count_underscores = url.count("_")
-    count_digits = sum(c.isdigit() for c in url)
+    count_digits, count_dots, count_hyphens, count_underscores, num_special, entropy = _url_stats(url)
     count_subdirs = path.count("/")
     count_query_params = query.count("&") + 1 if query else 0
     has_at = "@" in url
     has_double_slash_in_path = "//" in path and not url.startswith("//")
     suspicious_token_count = count_tokens_in_string(url)
     ratio_digits_to_length = count_digits / url_length if url_length else 0.0
-    num_special = sum(1 for c in url if c in SPECIAL_CHARS)
     ratio_special_to_length = num_special / url_length if url_length else 0.0
-    entropy = shannon_entropy(url)
     ip_in_host = has_ip_in_host(host)
     domain_age_days = -1
 
@@ -101,7 +156,7 @@ def extract_features(url: str) -> Dict[str, float]:
         "ratio_special_chars_to_length": ratio_special_to_length,
         "has_ip_in_host": int(ip_in_host),
         "domain_age_days": domain_age_days,
-        "scheme": scheme.lower(),            # small categorical
+        "scheme": scheme,                    # small categorical (already lowercase)
         "subdomain_length": subdomain_length,
         "subdomain_depth": subdomain_depth,
         "domain_length": domain_length,
@@ -109,6 +164,30 @@ def extract_features(url: str) -> Dict[str, float]:
     })
     return features
 
+# Below this many distinct URLs, worker start-up costs more than it saves
+PARALLEL_MIN_URLS = 50_000
+
+def extract_features_batch(urls, n_jobs: int = 1) -> List[Dict[str, float]]:
+    """extract_features over many URLs, computing each distinct URL once.
+
+    With n_jobs != 1 (joblib semantics, -1 = all cores) and at least
+    PARALLEL_MIN_URLS distinct URLs, extraction runs in worker processes.
+    Repeated URLs share one features dict, so callers must copy a row
+    before mutating it.
+    """
+    urls = list(urls)
+    distinct = list(dict.fromkeys(urls))
+    rows = None
+    if n_jobs != 1 and len(distinct) >= PARALLEL_MIN_URLS:
+        from joblib import Parallel, delayed, effective_n_jobs
+
+        if effective_n_jobs(n_jobs) > 1:
+            rows = Parallel(n_jobs=n_jobs, batch_size=2048)(delayed(extract_features)(u) for u in distinct)
+    if rows is None:
+        rows = [extract_features(u) for u in distinct]
+    by_url = dict(zip(distinct, rows))
+    return [by_url[u] for u in urls]
+
 def features_schema() -> Dict[str, str]:
     return {
         "url_length": "Total length of the URL string",
@@ -0,0 +1,18 @@
+"""Gunicorn settings for production serving.
+
+Usage: gunicorn -c gunicorn_conf.py app:app
+
+preload_app imports app.py (and therefore load_model()) once in the master
+process; forked workers share the loaded pipeline copy-on-write instead of each
+unpickling their own copy. Background threads (predict batcher, DB log writer)
+are started lazily, so each worker starts its own after the fork.
+"""
+import os
+
+preload_app = True
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8081")
+workers = int(os.getenv("GUNICORN_WORKERS", str(os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# POST /train runs in-request and can take a while on large datasets
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
@@ -2,6 +2,7 @@ import json
 import os
 import tempfile
 import pytest
+import app as app_module
 from app import app, load_model
 from config import MODEL_FILE
 
@@ -38,3 +39,180 @@ def test_predict_no_model(client, monkeypatch):
         if moved and temp and os.path.exists(temp.name):
             os.rename(temp.name, p)
             load_model()
+
+def test_predict_host_rules(client, monkeypatch):
+    rules = app_module._compile_host_rules(["example.com"], ["evil.example.com"])
+    monkeypatch.setattr(app_module, "_HOST_RULES", rules)
+    j = client.post("/predict", json={"url": "https://www.example.com/login"}).get_json()
+    assert (j["prediction"], j["rule"]) == ("legitimate", "allow")
+    j = client.post("/predict", json={"url": "http://a.evil.example.com/"}).get_json()
+    assert (j["prediction"], j["rule"]) == ("phishing", "block")
+    j = client.post("/predict", json={"url": "http://notexample.com/"}).get_json()
+    assert "rule" not in j
+
+def test_linear_fast_path_matches_pipeline(monkeypatch):
+    import numpy as np
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.feature_extraction import DictVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from features import extract_features
+
+    urls = ["http://example.com/", "https://paypal.verify-login.xyz/a?b=1", "http://10.0.0.1/secure/bank",
+            "https://github.com/org/repo", "http://update-account.example.net/login.php?id=42"] * 4
+    X = [extract_features(u) for u in urls]
+    y = [0, 1, 1, 0, 1] * 4
+    pipe = Pipeline([
+        ("vectorizer", DictVectorizer(sparse=True)),
+        ("svd", TruncatedSVD(n_components=4, random_state=0)),
+        ("scaler", StandardScaler(with_mean=False)),
+        ("clf", LogisticRegression()),
+    ]).fit(X, y)
+    cache = app_module._build_inference_cache(pipe)
+    assert cache["linear"] is not None
+    monkeypatch.setattr(app_module, "MODEL", pipe)
+    monkeypatch.setattr(app_module, "_INFERENCE_CACHE", cache)
+    out = app_module._predict_batch(X)
+    assert [p for p, _ in out] == list(pipe.predict(X))
+    assert np.allclose([p for _, p in out], pipe.predict_proba(X)[:, 1], atol=1e-5)
+
+@pytest.fixture
+def model_state(monkeypatch):
+    """Let a test load other models; the app's model globals are restored afterwards."""
+    for name in ("MODEL", "MODEL_META", "MODEL_COMPATIBLE", "_INFERENCE_CACHE", "_RESP_TAIL",
+                 "_MODEL_MTIME", "_HEALTH_BODY", "_RELOAD_CHECKED_AT", "_CACHE_EPOCH", "_AUTO_TRAIN_ATTEMPTED"):
+        monkeypatch.setattr(app_module, name, getattr(app_module, name))
+    yield
+    app_module._clear_url_caches()
+
+def _dump_model(path, version):
+    import joblib
+    from sklearn.feature_extraction import DictVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import Pipeline
+    pipe = Pipeline([("vectorizer", DictVectorizer()), ("clf", LogisticRegression())])
+    pipe.fit([{"a": 0.0}, {"a": 1.0}], [0, 1])
+    joblib.dump({"pipeline": pipe, "meta": {"model_version": version}}, path)
+    # Distinct mtimes even on filesystems with coarse timestamps
+    stamp = {"v1": 1_000_000_000, "v2": 2_000_000_000, "v3": 3_000_000_000}[version]
+    os.utime(path, ns=(stamp, stamp))
+
+def test_workers_pick_up_retrained_model(model_state, monkeypatch, tmp_path):
+    model_file = tmp_path / "model.joblib"
+    monkeypatch.setattr(app_module, "MODEL_FILE", model_file)
+    monkeypatch.setattr(app_module, "CACHE_EPOCH_FILE", tmp_path / "cache_epoch")
+    monkeypatch.setattr(app_module, "MODEL_RELOAD_CHECK_SECONDS", 60)
+    _dump_model(model_file, "v1")
+    app_module.load_model()
+    assert app_module.MODEL_META["model_version"] == "v1"
+    # Another worker retrains: noticed on the next check, but no more than once per interval
+    _dump_model(model_file, "v2")
+    monkeypatch.setattr(app_module, "_RELOAD_CHECKED_AT", float("-inf"))
+    app_module._check_model_file()
+    assert app_module.MODEL_META["model_version"] == "v2"
+    _dump_model(model_file, "v3")
+    app_module._check_model_file()
+    assert app_module.MODEL_META["model_version"] == "v2"
+
+def test_cache_clear_reaches_other_workers(model_state, monkeypatch, tmp_path):
+    epoch_file = tmp_path / "cache_epoch"
+    monkeypatch.setattr(app_module, "CACHE_EPOCH_FILE", epoch_file)
+    monkeypatch.setattr(app_module, "MODEL_RELOAD_CHECK_SECONDS", 60)
+    monkeypatch.setattr(app_module, "_RELOAD_CHECKED_AT", float("-inf"))
+    app_module._check_model_file()
+    app_module._extract_cached("http://example.com/")
+    assert app_module._extract_cached.cache_info().currsize == 1
+    # Written by the worker that served POST /admin/cache/clear
+    epoch_file.write_text("1")
+    monkeypatch.setattr(app_module, "_RELOAD_CHECKED_AT", float("-inf"))
+    app_module._check_model_file()
+    assert app_module._extract_cached.cache_info().currsize == 0
+
+def test_onnx_serving_matches_pipeline(model_state, monkeypatch, tmp_path):
+    pytest.importorskip("skl2onnx")
+    pytest.importorskip("onnxruntime")
+    import joblib
+    import numpy as np
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.feature_extraction import DictVectorizer
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from features import extract_features
+    from train import export_onnx
+
+    urls = ["http://example.com/", "https://paypal.verify-login.xyz/a?b=1", "http://10.0.0.1/secure/bank",
+            "https://github.com/org/repo", "http://update-account.example.net/login.php?id=42"] * 4
+    X = [extract_features(u) for u in urls]
+    y = [0, 1, 1, 0, 1] * 4
+    pipe = Pipeline([
+        ("vectorizer", DictVectorizer(sparse=True, dtype=np.float32)),
+        ("svd", TruncatedSVD(n_components=4, random_state=0)),
+        ("scaler", StandardScaler(with_mean=False)),
+        ("clf", RandomForestClassifier(n_estimators=10, random_state=0)),
+    ]).fit(X, y)
+    model_file = tmp_path / "model.joblib"
+    monkeypatch.setattr(app_module, "MODEL_FILE", model_file)
+    joblib.dump({"pipeline": pipe, "meta": {"model_version": "v1"}}, model_file)
+    assert export_onnx(pipe, model_file, "v1") is not None
+    app_module.load_model()
+    assert app_module._INFERENCE_CACHE.get("onnx") is not None
+    out = app_module._predict_batch(X)
+    assert [p for p, _ in out] == list(pipe.predict(X))
+    assert np.allclose([p for _, p in out], pipe.predict_proba(X)[:, 1], atol=1e-5)
+
+    # A sidecar exported for another model version is never served
+    joblib.dump({"pipeline": pipe, "meta": {"model_version": "v2"}}, model_file)
+    os.utime(model_file, ns=(2_000_000_000, 2_000_000_000))
+    app_module.load_model()
+    assert app_module.MODEL_META["model_version"] == "v2"
+    assert app_module._INFERENCE_CACHE.get("onnx") is None
+    assert [p for p, _ in app_module._predict_batch(X)] == list(pipe.predict(X))
+
+def test_default_classifier_exports_to_onnx(tmp_path):
+    pytest.importorskip("skl2onnx")
+    ort = pytest.importorskip("onnxruntime")
+    import numpy as np
+    from features import extract_features
+    from train import build_pipeline, export_onnx
+
+    urls = ["http://example.com/", "https://paypal.verify-login.xyz/a?b=1", "http://10.0.0.1/secure/bank",
+            "https://github.com/org/repo", "http://update-account.example.net/login.php?id=42"] * 8
+    X = [extract_features(u) for u in urls]
+    y = [0, 1, 1, 0, 1] * 8
+    pipe = build_pipeline().set_params(svd__n_components=4, clf__max_iter=20, clf__min_samples_leaf=2).fit(X, y)
+    # Raises when the installed skl2onnx/onnx/protobuf set cannot convert it
+    onnx_path = export_onnx(pipe, tmp_path / "model.joblib", "v1", raise_errors=True)
+    sess = ort.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+    labels, proba = sess.run(None, {"input": pipe[0].transform(X).toarray()})
+    assert list(labels) == list(pipe.predict(X))
+    assert np.allclose(proba[:, 1], pipe.predict_proba(X)[:, 1], atol=1e-5)
+
+def test_train_reports_onnx_export_failure(client, monkeypatch):
+    def fake_train(*args, **kwargs):
+        return {"meta": {}, "test_predictions": "preds.csv", "onnx": None, "onnx_error": "ImportError: no skl2onnx"}
+
+    monkeypatch.setattr(app_module, "_load_train_model", lambda: fake_train)
+    monkeypatch.setattr(app_module, "load_model", lambda: None)
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "test-admin-token")
+    resp = client.post("/train", json={}, headers={"X-ADMIN-TOKEN": "test-admin-token"})
+    assert resp.status_code == 200
+    assert resp.get_json()["onnx_error"] == "ImportError: no skl2onnx"
+
+def test_device_from_user_agent():
+    android = "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36"
+    mac = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15"
+    edge = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36 Edg/120.0"
+    assert app_module._device_from_user_agent(android) == "Android • Chrome"
+    assert app_module._device_from_user_agent(mac) == "macOS • Safari"
+    assert app_module._device_from_user_agent(edge) == "Windows • Edge"
+    assert app_module._device_from_user_agent("") == "unknown"
+
+def test_verify_password_rejects_malformed_bcrypt_hash():
+    import db
+    good = db._hash_password("s3cret")
+    assert db._verify_password(good, "s3cret")
+    assert not db._verify_password(good, "wrong")
+    assert not db._verify_password(good[:-1], "s3cret")
+    assert not db._verify_password(good[:6] + "x" + good[7:], "s3cret")
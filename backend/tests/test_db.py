@@ -0,0 +1,160 @@
+import queue
+import threading
+
+import mysql.connector
+import pytest
+
+import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((" ".join(sql.split()), params))
+
+    def executemany(self, sql, rows):
+        self.conn.batches.append(list(rows))
+
+    def fetchone(self):
+        return self.conn.fetchone_result
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    def __init__(self, fetchone_result=None):
+        self.executed = []
+        self.batches = []
+        self.fetchone_result = fetchone_result
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _row(i):
+    return db._prediction_row(f"http://example.com/{i}", {}, 0, 0.1, "dev", "127.0.0.1", {}, "v1")
+
+
+@pytest.fixture
+def log_queue(monkeypatch):
+    q = queue.Queue(maxsize=100)
+    monkeypatch.setattr(db, "_log_queue", q)
+    # No background thread: the tests drain the queue themselves
+    monkeypatch.setattr(db, "_ensure_log_writer", lambda: None)
+    monkeypatch.setattr(db, "_log_db_ok", threading.Event())
+    return q
+
+
+def test_flush_writes_queued_rows_in_batches(log_queue, monkeypatch):
+    conn = FakeConn()
+    monkeypatch.setattr(db, "LOG_BATCH_SIZE", 2)
+    monkeypatch.setattr(db, "_writer_connection", lambda: conn)
+    for i in range(5):
+        assert db.enqueue_prediction(f"http://example.com/{i}", {}, 0, 0.1, "dev", "127.0.0.1", {}, "v1")
+    db.flush_prediction_log()
+    assert [len(b) for b in conn.batches] == [2, 2, 1]
+    assert log_queue.empty()
+    assert conn.closed
+
+
+def test_write_log_batch_retries_on_fresh_connection(monkeypatch):
+    class DeadConn(FakeConn):
+        def cursor(self):
+            raise mysql.connector.OperationalError("gone away")
+
+    fresh = FakeConn()
+    monkeypatch.setattr(db, "_writer_connection", lambda: fresh)
+    assert db._write_log_batch([_row(1)], DeadConn()) is fresh
+    assert len(fresh.batches) == 1
+
+
+def test_full_queue_writes_inline_only_while_db_healthy(monkeypatch):
+    monkeypatch.setattr(db, "_log_queue", queue.Queue(maxsize=1))
+    monkeypatch.setattr(db, "_ensure_log_writer", lambda: None)
+    monkeypatch.setattr(db, "_log_db_ok", threading.Event())
+    inline = []
+    monkeypatch.setattr(db, "insert_predictions", lambda rows: inline.extend(rows) or len(rows))
+    args = ("http://example.com/", {}, 0, 0.1, "dev", "127.0.0.1", {}, "v1")
+    assert db.enqueue_prediction(*args)
+    # Queue full and the writer has not reached the DB yet: dropped
+    assert not db.enqueue_prediction(*args)
+    assert inline == []
+    db._log_db_ok.set()
+    assert db.enqueue_prediction(*args)
+    assert len(inline) == 1
+
+
+def test_overflow_connections_are_capped(monkeypatch):
+    class ExhaustedPool:
+        def get_connection(self):
+            raise mysql.connector.PoolError("pool exhausted")
+
+    monkeypatch.setattr(db, "_get_pool", lambda readonly=False: ExhaustedPool())
+    monkeypatch.setattr(db, "_connect", lambda readonly=False: FakeConn())
+    monkeypatch.setattr(db, "_overflow_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(db, "POOL_TIMEOUT_SECONDS", 0)
+    conn = db._checkout()
+    with pytest.raises(RuntimeError):
+        db._checkout()
+    conn.close()
+    db._checkout().close()
+
+
+def test_init_db_skips_migrations_when_version_matches(monkeypatch):
+    conn = FakeConn(fetchone_result=(db.SCHEMA_VERSION,))
+    monkeypatch.setattr(db, "_schema_ready", False)
+    monkeypatch.setattr(db, "_checkout", lambda readonly=False: conn)
+    db.init_db()
+    assert db._schema_ready
+    assert [sql.split()[0] for sql, _ in conn.executed] == ["SELECT"]
+    assert conn.closed
+
+
+@pytest.fixture
+def users_db(monkeypatch):
+    """One users row served by a fake connection; returns the executed statements."""
+    executed = []
+    row = [5, "alice@example.com", "alice", "$2b$04$" + "x" * 53, "user", 0, None, None, 1, 2]
+
+    class UsersConn(FakeConn):
+        def __init__(self):
+            super().__init__(fetchone_result=tuple(row))
+            self.executed = executed
+
+    monkeypatch.setattr(db, "get_connection", lambda readonly=False: UsersConn())
+    monkeypatch.setattr(db, "_hash_password", lambda password: "$2b$04$" + "y" * 53)
+    monkeypatch.setattr(db, "USER_CACHE_TTL", 30)
+    monkeypatch.setattr(db, "_user_cache", {})
+    return executed
+
+
+def _selects(executed):
+    return sum(1 for sql, _ in executed if sql.startswith("SELECT"))
+
+
+def test_set_user_password_invalidates_cached_user(users_db):
+    user = db.get_user("alice")
+    assert "password_hash" not in user
+    db.get_user_by_id(5)
+    assert _selects(users_db) == 1
+    db.set_user_password(5, "new-password")
+    db.get_user("alice")
+    assert _selects(users_db) == 2
+
+
+def test_verify_user_password_reads_hash_from_db(users_db, monkeypatch):
+    db.get_user("alice")
+    seen = []
+    monkeypatch.setattr(db, "_verify_password", lambda ph, pw: seen.append(ph) or False)
+    assert db.verify_user_password("alice", "pw") is None
+    assert seen and _selects(users_db) == 2
@@ -1,5 +1,5 @@
 import pytest
-from features import extract_features
+from features import extract_features, extract_features_batch
 
 def test_basic_url_features():
     url = "https://example.com/login"
@@ -14,7 +14,17 @@ def test_ip_host_detection():
     f = extract_features(url)
     assert f["has_ip_in_host"] == 1
 
+def test_ip_host_detection_edge_cases():
+    assert extract_features("http://[2001:db8::1]:8080/x")["has_ip_in_host"] == 1
+    assert extract_features("http://example.com:8080/x")["has_ip_in_host"] == 0
+    assert extract_features("http://999.1.1.1/x")["has_ip_in_host"] == 0
+
 def test_suspicious_token_count():
     url = "http://secure-login.example/verify"
     f = extract_features(url)
     assert f["suspicious_token_count"] >= 1
+
+def test_batch_matches_scalar():
+    urls = ["http://a.example/x", "https://b.example/login?x=1", "http://a.example/x"]
+    rows = extract_features_batch(urls)
+    assert rows == [extract_features(u) for u in urls]
@@ -1,15 +1,18 @@
 import csv
+import logging
+import os
 import joblib
+import numpy as np
 import time
 from pathlib import Path
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.metrics import classification_report, roc_auc_score, accuracy_score
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.pipeline import Pipeline
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.decomposition import TruncatedSVD  # added
 from sklearn.preprocessing import StandardScaler  # added
-from features import extract_features
+from features import extract_features_batch
 from data_loader import load_dataset
 from config import MODEL_DIR, MODEL_FILE
 import traceback  # added
@@ -20,13 +23,21 @@ MODEL_FILE = Path(MODEL_FILE)
 
 MODEL_DIR.mkdir(parents=True, exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
 
 def build_pipeline():
-    """Builds a memory-friendly pipeline: DictVectorizer (sparse) -> SVD -> Scaler -> RandomForest."""
-    vectorizer = DictVectorizer(sparse=True)  # was: sparse=False
+    """Builds a memory-friendly pipeline: DictVectorizer (sparse) -> SVD -> Scaler -> HistGradientBoosting.
+
+    Features are float32 throughout (small integer counts and ratios need no
+    more), halving the memory the SVD and the classifier stream through.
+    """
+    vectorizer = DictVectorizer(sparse=True, dtype=np.float32)  # was: sparse=False
     svd = TruncatedSVD(n_components=256, random_state=42)
     scaler = StandardScaler(with_mean=False)
-    clf = RandomForestClassifier(n_estimators=200, random_state=42, n_jobs=-1)
+    # Histogram boosting: several times faster to fit and to predict than the
+    # previous 200-tree random forest, at a tenth of the file size
+    clf = HistGradientBoostingClassifier(max_iter=300, random_state=42)
     return Pipeline([
         ("vectorizer", vectorizer),
         ("svd", svd),
@@ -35,6 +46,45 @@ def build_pipeline():
     ])
 
 
+def export_onnx(model, save_path: Path, model_version: str, raise_errors: bool = False):
+    """Export the post-vectorizer part of the pipeline to ONNX next to the joblib file.
+
+    Requires ``skl2onnx``. The app serves through onnxruntime when the sidecar
+    exists and its embedded model_version matches the joblib metadata.
+    Returns the written path, or None when export is unavailable/failed
+    (re-raised instead with ``raise_errors``).
+    """
+    onnx_path = Path(save_path).with_suffix(".onnx")
+    # A sidecar from a previous model must never be served alongside the new one
+    if onnx_path.exists():
+        onnx_path.unlink()
+    try:
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        if raise_errors:
+            raise
+        return None
+    try:
+        vec = model.named_steps["vectorizer"]
+        clf = model.steps[-1][1]
+        onx = convert_sklearn(
+            model[1:],
+            initial_types=[("input", FloatTensorType([None, len(vec.feature_names_)]))],
+            options={id(clf): {"zipmap": False}},
+        )
+        prop = onx.metadata_props.add()
+        prop.key = "model_version"
+        prop.value = str(model_version)
+        onnx_path.write_bytes(onx.SerializeToString())
+        return onnx_path
+    except Exception as exc:
+        logger.warning("ONNX export skipped: %s", exc)
+        if raise_errors:
+            raise
+        return None
+
+
 def _capture_error(exc: Exception) -> dict:
     """Return a JSON-safe error payload for frontends."""
     return {
@@ -59,16 +109,20 @@ def train_model(
 
         # Load dataset
         dataset = load_dataset(data_path, label_column=label_column)
-        print(f"[train] loaded dataset with {len(dataset)} rows")
+        logger.info("loaded dataset with %d rows", len(dataset))
 
         # Extract features and labels
-        feature_rows = [extract_features(row["url"]) for row in dataset]
-        labels = [int(row["label"]) for row in dataset]
+        feature_rows = extract_features_batch((row["url"] for row in dataset), n_jobs=-1)
+        labels = np.fromiter((row["label"] for row in dataset), dtype=np.int8, count=len(dataset))
+        # The per-row record dicts are not needed past this point; drop them
+        # before fitting, which is where memory peaks
+        del dataset
 
         # Split data
         X_train, X_test, y_train, y_test = train_test_split(
             feature_rows, labels, test_size=0.20, random_state=42, stratify=labels
         )
+        del feature_rows, labels
 
         # Build pipeline
         pipeline = build_pipeline()
@@ -77,13 +131,13 @@ def train_model(
         if perform_gridsearch:
             param_grid = {
                 "svd__n_components": [128, 256],
-                "clf__n_estimators": [100, 200],
+                "clf__max_iter": [100, 300],
                 "clf__max_depth": [None, 10, 20],
             }
             gs = GridSearchCV(pipeline, param_grid, cv=3, scoring="f1", n_jobs=-1, verbose=1)
             gs.fit(X_train, y_train)
             model = gs.best_estimator_
-            print("[train] GridSearchCV best params:", gs.best_params_)
+            logger.info("GridSearchCV best params: %s", gs.best_params_)
         else:
             pipeline.fit(X_train, y_train)
             model = pipeline
@@ -93,17 +147,17 @@ def train_model(
         y_proba = model.predict_proba(X_test)[:, 1] if hasattr(model, "predict_proba") else None
 
         accuracy = accuracy_score(y_test, y_pred)
-        print(f"[train] Accuracy: {accuracy:.4f}")
-        print("[train] Classification report:")
-        print(classification_report(y_test, y_pred, digits=4))
+        logger.info("Accuracy: %.4f", accuracy)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Classification report:\n%s", classification_report(y_test, y_pred, digits=4))
 
         # Safeguard ROC AUC when only one class is present in y_test
-        if y_proba is not None and len(set(y_test)) > 1:
+        if y_proba is not None and np.unique(y_test).size > 1:
             try:
                 auc = roc_auc_score(y_test, y_proba)
-                print(f"[train] ROC AUC: {auc:.4f}")
+                logger.info("ROC AUC: %.4f", auc)
             except Exception as exc:
-                print(f"[train] ROC AUC unavailable: {exc}")
+                logger.warning("ROC AUC unavailable: %s", exc)
 
         # Save model
         model_info = {
@@ -115,33 +169,46 @@ def train_model(
         }
 
         save_path.parent.mkdir(parents=True, exist_ok=True)
-        joblib.dump({"pipeline": model, "meta": model_info}, save_path)
-        print(f"[train] model saved to {save_path}")
+        # Uncompressed so the app can memory-map it; written to a temp file and
+        # swapped in so a running app that has the old file mapped never sees
+        # it truncated mid-write.
+        tmp_path = save_path.with_name(save_path.name + ".tmp")
+        joblib.dump({"pipeline": model, "meta": model_info}, tmp_path, compress=0)
+        os.replace(tmp_path, save_path)
+        logger.info("model saved to %s", save_path)
+        # Reported to the caller: without the sidecar the app serves through
+        # sklearn, an order of magnitude slower per request
+        onnx_error = None
+        try:
+            onnx_path = export_onnx(model, save_path, model_info["model_version"], raise_errors=True)
+            logger.info("ONNX model saved to %s", onnx_path)
+        except Exception as exc:
+            onnx_path, onnx_error = None, f"{exc.__class__.__name__}: {exc}"
 
         # Save predictions to CSV
         preds_csv = save_path.parent / "test_predictions.csv"
         fieldnames = sorted({key for row in X_test for key in row.keys()})
 
         with preds_csv.open("w", newline="", encoding="utf-8") as fh:
-            writer = csv.DictWriter(fh, fieldnames=fieldnames + ["label", "pred", "prob"])
-            writer.writeheader()
-            probs = list(y_proba) if y_proba is not None else [None] * len(y_pred)
-            for row_feat, label, pred, prob in zip(X_test, y_test, y_pred, probs):
-                record = {name: row_feat.get(name, "") for name in fieldnames}
-                record.update({
-                    "label": int(label),
-                    "pred": int(pred),
-                    "prob": float(prob) if prob is not None else ""
-                })
-                writer.writerow(record)
-
-        print(f"[train] test split predictions saved to {preds_csv}")
-        print(f"[train] completed in {time.time() - start:.1f}s")
-        return {"meta": model_info, "test_predictions": str(preds_csv)}
+            writer = csv.writer(fh)
+            writer.writerow(fieldnames + ["label", "pred", "prob"])
+            probs = y_proba.tolist() if y_proba is not None else [""] * len(y_pred)
+            writer.writerows(
+                [row_feat.get(name, "") for name in fieldnames] + [int(label), int(pred), prob]
+                for row_feat, label, pred, prob in zip(X_test, y_test.tolist(), y_pred.tolist(), probs)
+            )
+
+        logger.info("test split predictions saved to %s", preds_csv)
+        logger.info("completed in %.1fs", time.time() - start)
+        return {
+            "meta": model_info,
+            "test_predictions": str(preds_csv),
+            "onnx": str(onnx_path) if onnx_path else None,
+            "onnx_error": onnx_error,
+        }
     except Exception as exc:
         err = _capture_error(exc)
-        print(f"[train][ERROR] {err['error_type']}: {err['error']}")
-        print(err["traceback"])
+        logger.error("%s: %s\n%s", err["error_type"], err["error"], err["traceback"])
         if raise_errors:
             raise
         return err
@@ -151,6 +218,7 @@ def train_model(
 if __name__ == "__main__":
     import argparse
 
+    logging.basicConfig(level=logging.INFO, format="[train] %(message)s")
     parser = argparse.ArgumentParser(description="Train phishing URL detection model")
     parser.add_argument("--data", help="Path to dataset CSV", default=None)
     parser.add_argument("--grid", action="store_true", help="Run GridSearchCV (slow)")
@@ -166,4 +234,4 @@ if __name__ == "__main__":
     )
     # Print a concise summary for CLI usage
     if "error" in result:
-        print("[train] Exited with error (see details above).")
+        logger.error("Exited with error (see details above).")